@@ -1,6 +1,5 @@
 import asyncio
 from asyncio import run as async_run
-from functools import wraps
 
 from dataclasses import dataclass
 
@@ -12,12 +11,16 @@ from aiogram.types import Message
 import logging
 from sys import stdout
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import DB_INITIALIZER
 import config
 
 from functional.settings_router import SettingsMaster
 import functional.crud as crud
+from functional.eta import DurationEstimator
+from functional.throttle import messages
+from functional.settings_cache import user_settings
+from functional.middlewares import DBSessionMiddleware
 from callbacks import models as cb_models
 
 ## INIT ##
@@ -33,14 +36,48 @@ logger.info(
 )
 
 logger.info('Database initialization...')
-SessionLocal = DB_INITIALIZER.init_db(cfg.DB_DNS)
+SessionLocal = DB_INITIALIZER.init_db(
+    cfg.DB_DNS,
+    pool_size=cfg.DB_POOL_SIZE,
+    max_overflow=cfg.DB_POOL_OVERFLOW,
+    pool_timeout=cfg.DB_POOL_TIMEOUT,
+    pool_recycle=cfg.DB_POOL_RECYCLE
+)
 logger.info('Database initialized...')
 
 #config
-API_URL = cfg.API_URL.split(":")
-crud.api.configure(API_URL[0], API_URL[1])
+API_URLS = [url.strip() for url in cfg.API_URL.split(",") if url.strip()]
+crud.api.configure(
+    API_URLS,
+    capacity=cfg.API_CAPACITY,
+    retry_after=cfg.API_RETRY_AFTER,
+    limit_per_host=cfg.API_CONN_LIMIT,
+    keepalive_timeout=cfg.API_KEEPALIVE,
+    dns_cache_ttl=cfg.API_DNS_TTL,
+    progress_min=cfg.API_PROGRESS_MIN,
+    progress_max=cfg.API_PROGRESS_MAX
+)
 crud.api.update_models()
-crud.queue.configure(cfg.QUEUE_LIMIT, {}, 10,1)
+crud.queue.configure(
+    cfg.QUEUE_LIMIT, {}, cfg.QUEUE_DEPTH,
+    workers=cfg.QUEUE_WORKERS or crud.api.capacity,
+    delivery_workers=cfg.DELIVERY_WORKERS,
+    delivery_max=cfg.DELIVERY_LIMIT,
+    scheduler=cfg.QUEUE_SCHEDULER,
+    custom_priorities=cfg.QUEUE_PRIORITIES,
+    coalesce_window=cfg.QUEUE_COALESCE_WINDOW,
+    coalesce_max=cfg.QUEUE_COALESCE_MAX,
+    journal=crud.jobs,
+    estimator=DurationEstimator(default_rate=cfg.ETA_DEFAULT_RATE),
+    shed_threshold=cfg.QUEUE_SHED_THRESHOLD,
+    shed_cost=cfg.QUEUE_SHED_COST
+)
+crud.jobs.configure(SessionLocal, cfg.JOB_MAX_ATTEMPTS)
+user_settings.configure(SessionLocal, cfg.SETTINGS_CACHE_USERS, cfg.SETTINGS_FLUSH_INTERVAL)
+crud.ledger.configure(SessionLocal if cfg.LEDGER_ENABLED else None, cfg.LEDGER_BATCH, cfg.LEDGER_FLUSH_INTERVAL)
+crud.results.configure(cfg.RESULT_CACHE_DIR, cfg.RESULT_CACHE_MB * 1024 * 1024)
+crud.files.configure(cfg.FILE_CACHE_MEMORY_MB * 1024 * 1024, cfg.FILE_CACHE_DIR, cfg.FILE_CACHE_MB * 1024 * 1024)
+messages.configure(cfg.TELEGRAM_RATE, cfg.TELEGRAM_CHAT_RATE, cfg.TELEGRAM_CHAT_BURST)
 bot = Bot(cfg.TOKEN.get_secret_value(), parse_mode=ParseMode.HTML)
 
 #styles register
@@ -57,43 +94,31 @@ crud.styles.add_new(
 
 
 
-#decorator
-def db_session(func):
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
-        db = SessionLocal()
-        try:
-            await func(db = db, *args, **kwargs)
-        finally:
-            db.close()
-    return wrapper
-
-
-
 #init dispatcher
 rp = Router()
-settings_master = SettingsMaster("settings", SessionLocal, 2, rp)
+settings_master = SettingsMaster("settings", 2, rp)
 
 
 #Commands itself
 @rp.message(CommandStart())
-@db_session
-async def command_start_handler(msg: Message, db:Session) -> None:
+async def command_start_handler(msg: Message, db:AsyncSession) -> None:
     logger.info(f"Recieved start command from {msg.from_user.id} - {msg.from_user.full_name}")
     await crud.start_command(msg, db)
 
 @rp.message(F.text) #yep any message will cause generation
-@db_session
-async def echo_handler(msg: types.Message, db:Session) -> None:
+async def echo_handler(msg: types.Message, db:AsyncSession) -> None:
     logger.info(f"Recieved generation command from {msg.from_user.id} - {msg.from_user.full_name}")
     await crud.any_msg(msg, db)
 
 
 @rp.callback_query(cb_models.ImageOptions.filter())
-@db_session
-async def img_reaction_query(query: types.CallbackQuery, callback_data: cb_models.ImageOptions, db:Session):
+async def img_reaction_query(query: types.CallbackQuery, callback_data: cb_models.ImageOptions, db:AsyncSession):
     await crud.image_reaction(query, callback_data, db, bot)
 
+@rp.callback_query(cb_models.JobOptions.filter(F.action == "cancel"))
+async def job_cancel_query(query: types.CallbackQuery, callback_data: cb_models.JobOptions):
+    await crud.cancel_job(query, callback_data)
+
 settings_master.register_command(
     "ratio", 
     lambda s: f'🖥 Change aspect [{s.aspect_x} / {s.aspect_y}]', 
@@ -112,16 +137,32 @@ settings_master.register_command(
     crud.count_setting 
 )
 
+async def on_startup():
+    await crud.api.start()
+
+async def on_shutdown():
+    await crud.api.close()
+    messages.close()
+    await user_settings.close() #write pending changes
+    await crud.ledger.close()
+    await crud.jobs.close()
+    await DB_INITIALIZER.engine.dispose()
+
 async def main():
     dp = Dispatcher()
+    dp.update.outer_middleware(DBSessionMiddleware(SessionLocal))
     dp.include_routers(
         rp,
     )
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     loop = asyncio.get_event_loop()
     loop.create_task(crud.queue.process_requests())
+    loop.create_task(crud.restore_jobs(bot))
 
-    await bot.get_updates(offset=-1)#skip updates
+    if cfg.SKIP_UPDATES:
+        await bot.get_updates(offset=-1)#skip updates
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
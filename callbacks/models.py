@@ -9,4 +9,8 @@ class ImageOptions(CallbackData, prefix="img"):
 
 class SetOptions(CallbackData, prefix="set"):
     mode: str
-    value: str
\ No newline at end of file
+    value: str
+
+class JobOptions(CallbackData, prefix="job"):
+    action: Literal["cancel"]
+    ticket: str
\ No newline at end of file
@@ -1,14 +1,52 @@
 from pydantic_settings import BaseSettings, PydanticBaseSettingsSource
 
-from typing import Tuple, Type
+from typing import Literal, Tuple, Type
 
 from pydantic import Field, SecretStr
 
 class Config(BaseSettings):
     DB_DNS: str = Field(default = "sqlite:///database.db")
+    DB_POOL_SIZE: int = Field(description="Database connections kept open", default=5)
+    DB_POOL_OVERFLOW: int = Field(description="Extra database connections opened under load", default=10)
+    DB_POOL_TIMEOUT: float = Field(description="How long handler waits for free database connection (seconds)", default=30)
+    DB_POOL_RECYCLE: int = Field(description="Reconnect database connections older than this (seconds), -1 - never", default=1800)
     TOKEN: SecretStr = Field(description="Telegram bot token")
-    API_URL: str = Field(description="SDWebUI URL", default="localhost:7860")
+    API_URL: str = Field(description="SDWebUI URL, several backends can be given as comma separated list", default="localhost:7860")
+    API_CAPACITY: int = Field(description="Parallel jobs per SDWebUI backend", default=1)
+    API_RETRY_AFTER: float = Field(description="How long failed SDWebUI backend is skipped (seconds)", default=30)
     QUEUE_LIMIT: int = Field(description="Limit for user queue", default=4)
+    QUEUE_DEPTH: int = Field(description="Max jobs waiting in global queue, new jobs are rejected when full", default=10)
+    QUEUE_SHED_THRESHOLD: float = Field(description="Queue fill ratio from which expensive jobs are rejected", default=0.7)
+    QUEUE_SHED_COST: float = Field(description="Max job cost accepted under pressure (1.0 = one 512x512 image, 22 steps)", default=4)
+    QUEUE_WORKERS: int = Field(description="Concurrent generation workers, 0 - total backend capacity", default=0)
+    QUEUE_SCHEDULER: Literal["fifo", "round_robin", "deficit"] = Field(description="Queue order: plain FIFO or per-user fair scheduling", default="deficit")
+    QUEUE_PRIORITIES: dict[int, int] = Field(description="Priority class per telegram id, higher is served first", default={})
+    QUEUE_COALESCE_WINDOW: float = Field(description="Seconds to wait for compatible txt2img jobs to merge into one batch, 0 - disabled", default=0)
+    QUEUE_COALESCE_MAX: int = Field(description="Max images in merged txt2img batch", default=4)
+    ETA_DEFAULT_RATE: float = Field(description="Seconds per 512x512x22 steps image until real timings are collected", default=5)
+    RESULT_CACHE_DIR: str = Field(description="Directory for cached fixed-seed generations", default="cache/results")
+    RESULT_CACHE_MB: int = Field(description="Results cache size limit in MB, 0 - disabled", default=512)
+    FILE_CACHE_DIR: str = Field(description="Directory for cached telegram files (sent and downloaded images)", default="cache/files")
+    FILE_CACHE_MB: int = Field(description="Telegram files disk cache size limit in MB, 0 - disabled", default=256)
+    FILE_CACHE_MEMORY_MB: int = Field(description="Telegram files memory cache size limit in MB", default=64)
+    SETTINGS_CACHE_USERS: int = Field(description="Users whose settings are kept in memory", default=10000)
+    SETTINGS_FLUSH_INTERVAL: float = Field(description="Delay before changed settings are written to DB (seconds)", default=5)
+    LEDGER_ENABLED: bool = Field(description="Record every generation with per-stage timings to DB", default=True)
+    LEDGER_BATCH: int = Field(description="Generation records written to DB at once", default=50)
+    LEDGER_FLUSH_INTERVAL: float = Field(description="Max delay before generation records are written (seconds)", default=10)
+    JOB_MAX_ATTEMPTS: int = Field(description="Jobs interrupted this many times are not restored again", default=3)
+    SKIP_UPDATES: bool = Field(description="Drop telegram updates received while bot was offline", default=False)
+    DELIVERY_WORKERS: int = Field(description="Concurrent result encoding/upload workers", default=2)
+    DELIVERY_LIMIT: int = Field(description="Finished jobs waiting for delivery before generation pauses", default=8)
+    TELEGRAM_RATE: float = Field(description="Max bot messages and edits per second, all chats", default=25)
+    TELEGRAM_CHAT_RATE: float = Field(description="Max bot messages and edits per second in one chat", default=1)
+    TELEGRAM_CHAT_BURST: int = Field(description="Messages one chat can get at once before TELEGRAM_CHAT_RATE applies", default=3)
+
+    API_CONN_LIMIT: int = Field(description="Max pooled connections per SDWebUI host", default=8)
+    API_KEEPALIVE: float = Field(description="Keep-alive timeout for idle SDWebUI connections (seconds)", default=60)
+    API_DNS_TTL: int = Field(description="DNS cache TTL for SDWebUI host (seconds)", default=300)
+    API_PROGRESS_MIN: float = Field(description="Fastest progress poll interval, used when job is close to finish (seconds)", default=0.5)
+    API_PROGRESS_MAX: float = Field(description="Slowest progress poll interval, used while job is waiting (seconds)", default=3)
 
     @classmethod
     def settings_customise_sources(
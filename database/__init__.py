@@ -1,3 +1,4 @@
 from .db import DB_INITIALIZER, Database_Initializer
+from .ledger import GenerationLedger
 
-__all__ = [DB_INITIALIZER, Database_Initializer]
\ No newline at end of file
+__all__ = [DB_INITIALIZER, Database_Initializer, GenerationLedger]
\ No newline at end of file
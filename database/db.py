@@ -1,15 +1,110 @@
-from sqlalchemy import create_engine
+import logging
+
+from sqlalchemy import BigInteger, Integer, create_engine, make_url, select, delete, func, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger("telebot")
+
+#async driver per dialect, used for all runtime queries
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
 
 class Database_Initializer():
     def __init__(self, base):
         self.base = base
+        self.engine = None #async engine, disposed on shutdown
+
+    @staticmethod
+    def async_dsn(dsn: str) -> str:
+        scheme, rest = dsn.split("://", 1)
+        dialect = scheme.split("+", 1)[0]
+        if dialect not in ASYNC_DRIVERS:
+            return dsn
+        return f"{ASYNC_DRIVERS[dialect]}://{rest}"
+
+    #ids which became BigInteger in models stay 32-bit in existing tables. sqlite integers are 64-bit anyway
+    def widen_columns(self, engine):
+        if engine.dialect.name != "postgresql":
+            return
+        inspector = inspect(engine)
+        quote = engine.dialect.identifier_preparer.quote
+        for table in self.base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"]: column["type"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if not isinstance(column.type, BigInteger) or column.name not in existing:
+                    continue
+                if isinstance(existing[column.name], BigInteger) or not isinstance(existing[column.name], Integer):
+                    continue
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {quote(table.name)} ALTER COLUMN {quote(column.name)} TYPE BIGINT"))
+                logger.warning(f"Column {table.name}.{column.name} widened to BIGINT")
 
-    def init_db(self, dsn):
+    #old databases could get several users per telegram id, oldest one is kept (it was the one get_user returned)
+    def merge_duplicate_users(self, engine):
+        users = self.base.metadata.tables["user"]
+        settings = self.base.metadata.tables["user_settings"]
+
+        keep = select(func.min(users.c.id)).where(users.c.telegram_id.is_not(None)).group_by(users.c.telegram_id)
+        duplicates = select(users.c.id).where(users.c.telegram_id.is_not(None), users.c.id.not_in(keep))
+        with engine.begin() as conn:
+            conn.execute(delete(settings).where(settings.c.user_id.in_(duplicates)))
+            removed = conn.execute(delete(users).where(users.c.id.in_(duplicates))).rowcount
+        if removed:
+            logger.warning(f"Removed {removed} duplicate users")
+
+    #create_all skips columns added to models of existing tables, nullable ones are added here
+    def add_columns(self, engine):
+        inspector = inspect(engine)
+        quote = engine.dialect.identifier_preparer.quote
+        for table in self.base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column.type.compile(engine.dialect)}"))
+                logger.warning(f"Added column {table.name}.{column.name}")
+
+    #create_all skips indexes of existing tables, so indexes added to models later are created here.
+    #Missing unique index breaks ON CONFLICT inserts, so startup fails instead
+    def create_indexes(self, engine):
+        for table in self.base.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(bind=engine, checkfirst=True)
+                except Exception as E:
+                    if index.unique:
+                        raise RuntimeError(f"Can't create unique index {index.name}") from E
+                    logger.error(f"Can't create index {index.name}: {E}")
+
+    #schema is created with blocking engine once, bot works through async sessions.
+    #pool_options: pool_size, max_overflow, pool_timeout, pool_recycle of async engine
+    def init_db(self, dsn, **pool_options) -> async_sessionmaker:
         engine = create_engine(dsn)
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
         self.base.metadata.create_all(bind=engine)
+        self.add_columns(engine)
+        self.widen_columns(engine)
+        self.merge_duplicate_users(engine)
+        self.create_indexes(engine)
+        engine.dispose()
+
+        url = make_url(self.async_dsn(dsn))
+        if url.get_backend_name() == "sqlite":
+            if url.database in (None, "", ":memory:"):
+                pool_options = {} #single shared connection, nothing to size
+            else:
+                pool_options["poolclass"] = AsyncAdaptedQueuePool #default for sqlite files opens connection per session
+        self.engine = create_async_engine(url, pool_pre_ping=True, **pool_options)
+        SessionLocal = async_sessionmaker(self.engine, autoflush=False, expire_on_commit=False)
 
         return SessionLocal
     
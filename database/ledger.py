@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from . import models
+
+
+logger = logging.getLogger("telebot")
+
+STAGES = ("enqueued", "started", "response", "decoded", "encoded", "uploaded")
+
+
+#generation records are buffered and inserted in batches, never on the delivery path
+class GenerationLedger():
+    def __init__(self, session_maker = None, batch_size = 50, flush_interval = 10, max_pending = 5000):
+        self.configure(session_maker, batch_size, flush_interval, max_pending)
+
+    def configure(self, session_maker, batch_size = 50, flush_interval = 10, max_pending = 5000):
+        self.session_maker = session_maker
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending #rows dropped above this while DB is unavailable
+
+        self.pending: list[dict] = []
+        self.task: Optional[asyncio.Task] = None #timer, only waits
+        self.flushes: set[asyncio.Task] = set() #writes in progress, referenced until done
+
+    @staticmethod
+    def stage_times(timings: dict[str, float]) -> dict[str, datetime]:
+        return {
+            f"{stage}_at": datetime.utcfromtimestamp(timings[stage]) if timings.get(stage) else None
+            for stage in STAGES
+        }
+
+    #timings - stage name -> unix time, see STAGES
+    def record(self, timings: dict[str, float], **row):
+        if self.session_maker is None:
+            return
+        if len(self.pending) >= self.max_pending:
+            logger.warning("Generation ledger is full, record dropped")
+            return
+        self.pending.append({**row, **self.stage_times(timings)})
+
+        if len(self.pending) >= self.batch_size and not self.flushes:
+            self.__start_flush()
+        else:
+            self.__schedule()
+
+    def __start_flush(self):
+        task = asyncio.create_task(self.flush())
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    def __schedule(self):
+        if self.task is None or self.task.done() or self.task is asyncio.current_task():
+            self.task = asyncio.create_task(self.__flush_later())
+
+    #timer never writes itself, so close() can cancel it without interrupting a write
+    async def __flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.__start_flush()
+
+    async def __insert(self, rows: list[dict]):
+        async with self.session_maker() as db:
+            await db.execute(insert(models.Generation), rows)
+            await db.commit()
+
+    #rows of failed batch were written one by one: bad rows are dropped, rest is kept if DB is unavailable
+    async def __insert_each(self, rows: list[dict]) -> list[dict]:
+        for it, row in enumerate(rows):
+            try:
+                await self.__insert([row])
+            except (OperationalError, InterfaceError) as E:
+                logger.error(f"Can't write generation records, will retry: {E}")
+                return rows[it:]
+            except Exception as E:
+                logger.error(f"Generation record dropped: {E}")
+            except BaseException:
+                self.pending = rows[it:] + self.pending #cancelled, written by close()
+                raise
+        return []
+
+    async def flush(self):
+        if not self.pending or self.session_maker is None:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            await self.__insert(rows)
+            return
+        except Exception as E:
+            logger.error(f"Can't write {len(rows)} generation records at once: {E}")
+        except BaseException:
+            self.pending = rows + self.pending #cancelled, written by close()
+            raise
+
+        retry = await self.__insert_each(rows)
+        if retry:
+            self.pending = retry + self.pending
+            del self.pending[:max(len(self.pending) - self.max_pending, 0)]
+            self.__schedule() #retry later
+
+    async def close(self):
+        while self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True) #writes in progress are finished, not cancelled
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+        await self.flush()
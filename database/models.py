@@ -1,7 +1,8 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, Enum, Float
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String, Date, DateTime, Enum, Float, JSON
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.dialects.postgresql import JSONB
 from typing import Literal
+from datetime import datetime
 from sqlalchemy.orm import relationship
 
 from .db import Base
@@ -45,7 +46,48 @@ class User(Base):
     __tablename__ = "user"
 
     id = Column(Integer, primary_key=True, index=True)
-    telegram_id = Column(Integer)
+    telegram_id = Column(BigInteger, unique=True, index=True) #telegram ids don't fit 32 bits
     settings = relationship("UserSettings", back_populates="user", uselist=False, cascade="all, delete-orphan")
     
-UserSettings.user = relationship("User", back_populates="settings")
\ No newline at end of file
+UserSettings.user = relationship("User", back_populates="settings")
+
+
+class Job(Base):
+    __tablename__ = "job"
+
+    id = Column(Integer, primary_key=True, index=True)
+    telegram_id = Column(BigInteger, index=True) #telegram ids don't fit 32 bits, supergroup chats are -100...
+    chat_id = Column(BigInteger)
+    kind = Column(String) #txt2img, txt2img_sdupscale, img2img
+    params = Column(JSON)
+    caption = Column(String, default="")
+    source_file_id = Column(String, nullable=True) #telegram file used as img2img input
+    ticket = Column(String, nullable=True) #cancel button of queue message, kept over restarts
+    state = Column(String, default="queued", index=True)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+#one row per finished generation, for capacity planning. Stage times are UTC, null if stage was skipped
+class Generation(Base):
+    __tablename__ = "generation"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, nullable=True, index=True)
+    telegram_id = Column(BigInteger, index=True)
+    chat_id = Column(BigInteger)
+    kind = Column(String)
+    params = Column(JSON)
+    state = Column(String) #delivered, failed
+    cached = Column(Boolean, default=False) #served from results cache, no backend work
+    images = Column(Integer, default=0)
+    result_bytes = Column(Integer, default=0)
+
+    enqueued_at = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True) #taken by queue worker
+    response_at = Column(DateTime, nullable=True) #backend started answering
+    decoded_at = Column(DateTime, nullable=True) #response body parsed, images decoded
+    encoded_at = Column(DateTime, nullable=True) #upload payload ready, delivery worker took the job
+    uploaded_at = Column(DateTime, nullable=True) #all images sent to telegram
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
 from typing import Optional
+from dataclasses import dataclass
 from functional.shared import ImageToBase64
 from PIL import Image
 
@@ -20,6 +21,23 @@ class SDProgress(BaseModel):
     text_info: Optional[str] = None
 
 
+#work estimation of single job, 1.0 is 512x512, 22 steps, one image
+@dataclass
+class JobCost():
+    width: int = 512
+    height: int = 512
+    steps: int = 22
+    batch: int = 1
+    upscale: float = 0 #upscale factor, 0 - no upscale
+
+    @property
+    def value(self) -> float:
+        value = (self.width * self.height * self.steps * self.batch) / (512 * 512 * 22)
+        if self.upscale > 0:
+            value *= 1 + self.upscale ** 2
+        return value
+
+
 class txt2img_params():
     prompt = ""
     negative_prompt = ""
@@ -75,11 +93,20 @@ class txt2img_params():
     def to_dict(self):
         return {attr: getattr(self, attr) for attr in dir(self) if not callable(getattr(self, attr)) and not attr.startswith("__")}
 
+    def cost(self) -> JobCost:
+        return JobCost(self.width, self.height, self.steps, self.batch_size * self.n_iter)
+
 class txt2img_sdupscale_params(txt2img_params):
     upscaler="R-ESRGAN 4x+ Anime6B"
     overlap=64
     upscale_factor=2
 
+    def cost(self) -> JobCost:
+        return JobCost(self.width, self.height, self.steps, self.batch_size * self.n_iter, self.upscale_factor)
+
+#img2img fields holding images, sent separately from the rest of request body
+IMAGE_FIELDS = ("init_images", "mask")
+
 class img2img_params():
     init_images=[]
     prompt = ""
@@ -126,11 +153,22 @@ class img2img_params():
     save_images = False
     alwayson_scripts = {}
 
+    #everything except images
+    def fields(self) -> dict:
+        return {
+            attr: getattr(self, attr) for attr in dir(self)
+            if not callable(getattr(self, attr)) and not attr.startswith("__") and attr not in IMAGE_FIELDS
+        }
+
+    #never mutates params, so retries don't encode twice
     def to_dict(self):
-        self.init_images = [ImageToBase64(x) for x in self.init_images]
-        
-        if self.mask is not None:
-            self.mask = ImageToBase64(self.mask)
+        data = self.fields()
+        data["init_images"] = [ImageToBase64(x) for x in self.init_images]
+        data["mask"] = ImageToBase64(self.mask) if self.mask is not None else None
+        return data
 
-        return {attr: getattr(self, attr) for attr in dir(self) if not callable(getattr(self, attr)) and not attr.startswith("__")}
-    
\ No newline at end of file
+    def cost(self) -> JobCost:
+        upscale = 0
+        if self.script_name == "SD Upscale" and len(self.script_args) > 3:
+            upscale = self.script_args[3]
+        return JobCost(self.width, self.height, self.steps, self.batch_size * self.n_iter, upscale)
@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+
+logger = logging.getLogger("telebot")
+
+
+#size-bounded LRU of byte blobs, one file per key. Blocking, meant to be used from threads
+class DiskLRU():
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index: OrderedDict[str, int] = OrderedDict() #key -> size, oldest first
+        self.total = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.__load_index()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def __load_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self.__path(name)
+            if name.endswith(".tmp"):
+                os.remove(path) #unfinished write
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(entries):
+            self.index[name] = size
+            self.total += size
+        self.__evict()
+
+    def __evict(self):
+        while self.total > self.max_bytes and self.index:
+            key, size = self.index.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.__path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            return self.__get(key)
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            self.__put(key, data)
+
+    def __get(self, key: str) -> Optional[bytes]:
+        if key not in self.index:
+            return None
+        path = self.__path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.total -= self.index.pop(key)
+            return None
+
+        self.index.move_to_end(key)
+        os.utime(path) #keep LRU order across restarts
+        return data
+
+    def __put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.index:
+            self.total -= self.index.pop(key)
+
+        tmp = self.__path(key) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.__path(key))
+
+        self.index[key] = len(data)
+        self.total += len(data)
+        self.__evict()
+
+
+#finished generations keyed by canonical payload hash + model, for deterministic (fixed seed) jobs
+class ResultCache():
+    def __init__(self, directory: str = None, max_bytes: int = 0):
+        self.configure(directory, max_bytes)
+
+    def configure(self, directory: str, max_bytes: int):
+        self.store: Optional[DiskLRU] = None
+        if directory and max_bytes > 0:
+            self.store = DiskLRU(directory, max_bytes)
+
+    @property
+    def enabled(self) -> bool:
+        return self.store is not None
+
+    @staticmethod
+    def key(payload: dict, model: str) -> str:
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(f"{model}\n{canonical}".encode()).hexdigest()
+
+    #entry: header length, json header, then encoded images back to back
+    @staticmethod
+    def pack(images: list[bytes], parameters, info) -> bytes:
+        header = json.dumps({"sizes": [len(i) for i in images], "parameters": parameters, "info": info}, default=str).encode()
+        return b"".join([struct.pack(">I", len(header)), header, *images])
+
+    @staticmethod
+    def unpack(data: bytes) -> tuple[list[bytes], dict, dict]:
+        (length,) = struct.unpack(">I", data[:4])
+        header = json.loads(data[4:4 + length])
+        images = []
+        offset = 4 + length
+        for size in header["sizes"]:
+            images.append(data[offset:offset + size])
+            offset += size
+        return images, header["parameters"], header["info"]
+
+    async def get(self, key: str) -> Optional[tuple[list[bytes], dict, dict]]:
+        if not self.enabled or key is None:
+            return None
+        try:
+            data = await asyncio.to_thread(self.store.get, key)
+            return self.unpack(data) if data is not None else None
+        except Exception as E:
+            logger.error(f"Result cache read failed: {E}")
+            return None
+
+    async def put(self, key: str, images: list[bytes], parameters, info):
+        if not self.enabled or key is None:
+            return
+        try:
+            await asyncio.to_thread(self.store.put, key, self.pack(images, parameters, info))
+        except Exception as E:
+            logger.error(f"Result cache write failed: {E}")
+
+
+#telegram files keyed by file_unique_id: memory LRU in front of disk LRU.
+#Concurrent requests of same file share one download
+class FileCache():
+    def __init__(self, memory_bytes: int = 0, directory: str = None, max_bytes: int = 0):
+        self.configure(memory_bytes, directory, max_bytes)
+
+    def configure(self, memory_bytes: int, directory: str, max_bytes: int):
+        self.memory_bytes = memory_bytes
+        self.memory: OrderedDict[str, bytes] = OrderedDict() #oldest first
+        self.memory_total = 0
+        self.store: Optional[DiskLRU] = None
+        if directory and max_bytes > 0:
+            self.store = DiskLRU(directory, max_bytes)
+        self.pending: dict[str, asyncio.Future] = {} #downloads in progress
+
+    def __remember(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_total -= len(self.memory.pop(key))
+        self.memory[key] = data
+        self.memory_total += len(data)
+        while self.memory_total > self.memory_bytes:
+            _, old = self.memory.popitem(last=False)
+            self.memory_total -= len(old)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+            return data
+        if self.store is None:
+            return None
+        try:
+            data = await asyncio.to_thread(self.store.get, key)
+        except Exception as E:
+            logger.error(f"File cache read failed: {E}")
+            return None
+        if data is not None:
+            self.__remember(key, data)
+        return data
+
+    async def put(self, key: str, data: bytes):
+        self.__remember(key, data)
+        if self.store is None:
+            return
+        try:
+            await asyncio.to_thread(self.store.put, key, data)
+        except Exception as E:
+            logger.error(f"File cache write failed: {E}")
+
+    #cached file or result of load(), which is stored
+    async def fetch(self, key: str, load: Callable[[], Awaitable[bytes]]) -> bytes:
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        data = await self.get(key)
+        if data is not None:
+            return data
+        if key in self.pending: #started while cache was read
+            return await asyncio.shield(self.pending[key])
+
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            data = await load()
+            await self.put(key, data)
+            future.set_result(data)
+            return data
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as E:
+            future.set_exception(E)
+            future.exception() #retrieved, so unawaited failure is not logged
+            raise
+        finally:
+            del self.pending[key]
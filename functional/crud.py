@@ -2,22 +2,25 @@ import asyncio, logging, typing
 from functools import wraps
 from abc import ABC, abstractmethod
 
-from sqlalchemy.orm import Session
-from database import models
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import models, GenerationLedger
 
 from time import time
 from io import BytesIO
-from PIL import Image
 
-from aiogram import Bot
+from aiogram import Bot, types
 from aiogram.utils.text_decorations import markdown_decoration as md
-from aiogram.types import InlineKeyboardButton as IKB, InlineKeyboardMarkup, Message, CallbackQuery, BufferedInputFile
+from aiogram.types import InlineKeyboardButton as IKB, InlineKeyboardMarkup, InputMediaDocument, Message, CallbackQuery, BufferedInputFile
 
-from functional.sd_api import WebUIApi, WebUIApiResult, APIQueue, StyleFactory
+from functional.sd_api import WebUIApiPool, WebUIApiResult, APIQueue, StyleFactory
 from functional.api_models import txt2img_params, txt2img_sdupscale_params, img2img_params
 
-from .shared import ImageToBytes, KBCustom, RoundTo8, ConvertRatioToSize, get_user, clamp
-from .processors import default_processor, txt2img_processor, txt2img_sdupscale_processor, img2img_processor
+from .shared import ImageFormat, ImageSize, KBCustom, RoundTo8, ConvertRatioToSize, clamp
+from .settings_cache import user_settings
+from .processors import default_processor, queue_processor, txt2img_processor, txt2img_sdupscale_processor, img2img_processor
+from .job_store import JobStore, load_params, dump_params
+from .cache import ResultCache, FileCache
+from .throttle import messages
 from . import errors
 
 from callbacks import models as cb_models
@@ -27,12 +30,24 @@ from functional.settings_router import SettingsMaster
 
 
 logger = logging.getLogger("telebot")
-api = WebUIApi("", "") #configured in app.py
+api = WebUIApiPool() #configured in app.py
 queue = APIQueue()
 styles = StyleFactory()
+jobs = JobStore() #configured in app.py
+results = ResultCache() #configured in app.py
+files = FileCache() #configured in app.py
+ledger = GenerationLedger() #configured in app.py
+
+PROCESSORS = {p.kind: p for p in (txt2img_processor, txt2img_sdupscale_processor, img2img_processor)}
+PARAMS = {
+    txt2img_processor.kind: txt2img_params,
+    txt2img_sdupscale_processor.kind: txt2img_sdupscale_params,
+    img2img_processor.kind: img2img_params,
+}
 
 
 IMAGE_BASE_SIZE = RoundTo8(512)
+MEDIA_GROUP_MAX = 10 #telegram limit
 IMAGE_KEYBOARD = KBCustom(["↪️ Повтор","📜 DeepBooru"],
                           [cb_models.ImageOptions(mode="sameprompt").pack(),
                            cb_models.ImageOptions(mode="deepboru").pack()],2)
@@ -41,8 +56,8 @@ IMAGE_KEYBOARD = KBCustom(["↪️ Повтор","📜 DeepBooru"],
 ############
 # Commands #
 ############
-async def start_command(msg:Message, db:Session):
-    user = get_user(db, msg.from_user.id) #register if not exists
+async def start_command(msg:Message, db:AsyncSession):
+    await user_settings.get(db, msg.from_user.id) #register if not exists
 
     # try:
     #     await queue.put(user.telegram_id, asyncio.sleep(1))
@@ -59,16 +74,143 @@ async def start_command(msg:Message, db:Session):
 
 
 
-async def any_msg(msg:Message, db:Session):
-    user = get_user(db, msg.from_user.id)
-    settings = user.settings
+def queue_text(uid: int, params) -> str:
+    wait, done = queue.estimate(uid, params.cost())
+    return f"Placed in queue: `{queue.human_size()}`\nStart in `~{int(wait)}s`, done in `~{int(done)}s`"
+
+#single image goes with keyboard, several go as media groups followed by one keyboard message.
+#Media group items can't have keyboard, so keyboard message replies to the group
+async def send_images(target: Message, result: WebUIApiResult, caption: str) -> list[Message]:
+    markup = InlineKeyboardMarkup(inline_keyboard=IMAGE_KEYBOARD)
+    documents = []
+    for it, data in enumerate(result.raw_images):
+        _, ext = ImageFormat(data)
+        documents.append(BufferedInputFile(data, f"{result.info['all_seeds'][it]}.{ext}"))
+
+    if len(documents) == 1:
+        sent = await messages.send(target.chat.id, lambda: target.answer_document(document=documents[0], caption=caption, parse_mode="MarkdownV2", reply_markup=markup))
+        return [sent]
+
+    sent = []
+    for start in range(0, len(documents), MEDIA_GROUP_MAX):
+        group = [InputMediaDocument(media=document, caption=caption if it == 0 else None, parse_mode="MarkdownV2")
+                 for it, document in enumerate(documents[start:start + MEDIA_GROUP_MAX])]
+        sent += await messages.send(target.chat.id, lambda: target.answer_media_group(media=group))
+
+    await messages.send(target.chat.id, lambda: target.answer(caption, parse_mode="MarkdownV2", reply_markup=markup, reply_to_message_id=sent[0].message_id))
+    return sent
+
+def record_generation(processor: queue_processor, target: Message, result: WebUIApiResult, state: str, cached = False):
+    raw_images = result.raw_images if result else []
+    ledger.record(
+        {**processor.timings, **(result.timings if result else {})},
+        job_id=processor.job_id,
+        telegram_id=processor.uid,
+        chat_id=target.chat.id,
+        kind=processor.kind,
+        params=dump_params(processor.params),
+        state=state,
+        cached=cached,
+        images=len(raw_images),
+        result_bytes=sum(len(data) for data in raw_images),
+    )
+
+#cache_key - store delivered result in results cache under this key
+def make_delivery(processor: queue_processor, target: Message, caption: str, cache_key: str = None, cached = False):
+    async def proc_end(result: WebUIApiResult):
+        execution_time = processor.get_process_time()
+        if not result:
+            await processor.msg_update("Error\. No data from server", final=True)
+            record_generation(processor, target, result, JobStore.FAILED, cached)
+            return
+        await processor.msg_update(f"Done in `{int(execution_time)}` seconds", final=True)
+
+        processor.timings["encoded"] = time() #backend bytes are sent as is, upload payload is ready
+        try:
+            sent = await send_images(target, result, caption)
+        except Exception:
+            record_generation(processor, target, result, JobStore.FAILED, cached)
+            raise
+        processor.timings["uploaded"] = time()
+        record_generation(processor, target, result, JobStore.DELIVERED, cached)
+
+        for message, data in zip(sent, result.raw_images):
+            if message.document:
+                await files.put(message.document.file_unique_id, data) #reactions on it won't download it back
+
+        await results.put(cache_key, result.raw_images, result.parameters, result.info)
+    return proc_end
+
+#results cache key of processor job, None if job is not cacheable
+async def result_key(processor: queue_processor) -> str:
+    if not results.enabled:
+        return None
+    payload = processor.deterministic_payload()
+    if payload is None:
+        return None
+    model = await api.get_checkpoint()
+    if model is None:
+        return None
+    return ResultCache.key(payload, model)
+
+#deliver from results cache without touching queue. Returns False on cache miss
+async def deliver_cached(processor: queue_processor, target: Message, caption: str, cache_key: str) -> bool:
+    cached = await results.get(cache_key)
+    if cached is None:
+        return False
+
+    images, parameters, info = cached
+    processor.initial_message = await messages.send(target.chat.id, lambda: target.answer("Found in cache"))
+    processor.start_time = processor.end_time = time()
+    await make_delivery(processor, target, caption, cached=True)(WebUIApiResult(images, parameters, info))
+    return True
+
+#record job durably, then put it into queue. Raises errors.MaxQueueReached, errors.SystemBusy
+async def enqueue(processor: queue_processor, uid: int, target: Message, caption: str, source_file_id: str = None, cache_key: str = None):
+    processor.set_end_func(make_delivery(processor, target, caption, cache_key))
+    processor.job_id = await jobs.add(uid, target.chat.id, processor.kind, processor.params, caption, source_file_id, processor.ticket)
 
-    text = msg.text or msg.caption or ""
-    if len(text) < 1:
-        await msg.answer("Please, provide text for generation")
+    try:
+        await processor.to_queue(uid)
+    except (errors.MaxQueueReached, errors.SystemBusy):
+        await jobs.mark(processor.job_id, JobStore.REJECTED)
+        raise
+
+def rejection_text(E: BaseException) -> str:
+    if isinstance(E, errors.SystemBusy):
+        return f"System is busy\. Please retry in `~{max(int(E.retry_after), 1)}` seconds"
+    return "You reached queue limit\. Please wait before using it again"
+
+#admission check, queue message and enqueue. Rejected jobs never touch the DB
+async def submit(target: Message, user: types.User, params, processor_cls, caption: str, source_file_id: str = None):
+    processor = processor_cls(api, queue, params, initial_message=None)
+    processor.uid = user.id
+    cache_key = await result_key(processor)
+    if await deliver_cached(processor, target, caption, cache_key):
+        logger.info(f"User {user.full_name} with ID:[{user.id}] served from results cache")
+        return
 
-    style = styles.stylize(settings.quality_tag, text)
+    try:
+        queue.check(user.id, params.cost())
+    except (errors.MaxQueueReached, errors.SystemBusy) as E:
+        await messages.send(target.chat.id, lambda: target.answer(rejection_text(E), parse_mode="MarkdownV2"))
+        logger.info(f"User {user.full_name} with ID:[{user.id}] rejected: {E}")
+        return
+
+    text = queue_text(user.id, params)
+    update_message = await messages.send(target.chat.id, lambda: target.answer(text, parse_mode="MarkdownV2", reply_markup=processor.cancel_markup()))
+    processor.initial_message = update_message
 
+    try:
+        await enqueue(processor, user.id, target, caption, source_file_id, cache_key)
+    except (errors.MaxQueueReached, errors.SystemBusy) as E:
+        messages.edit(update_message, rejection_text(E), final=True)
+        logger.info(f"User {user.full_name} with ID:[{user.id}] rejected: {E}")
+    except Exception as E:
+        messages.edit(update_message, "Error\. Can't queue generation, please retry later", final=True)
+        logger.error(f"Can't queue job of user {user.full_name} with ID:[{user.id}]: {E}")
+
+def generation_params(settings: models.UserSettings, style: StyleFactory.Style) -> txt2img_params:
     if not settings.enable_hr:
         params = txt2img_params()
     else:
@@ -82,154 +224,145 @@ async def any_msg(msg:Message, db:Session):
     params.steps = settings.steps
     params.batch_size = settings.n_iter
     params.sampler_name = settings.sampler
+    params.seed = settings.seed
+    return params
 
-    update_message = await msg.answer(f"Placed in queue: `{queue.human_size()}`", parse_mode="MarkdownV2")
-
+def generation_processor(params: txt2img_params) -> type[queue_processor]:
     if isinstance(params, txt2img_sdupscale_params):
-        processor = txt2img_sdupscale_processor(api, queue, params, initial_message=update_message)
-    elif isinstance(params, txt2img_params):
-        processor = txt2img_processor(api, queue, params, initial_message=update_message)
-    
+        return txt2img_sdupscale_processor
+    return txt2img_processor
 
-    async def proc_end(result: WebUIApiResult):
-        execution_time = processor.get_process_time()
-        await processor.msg_update(f"Done in `{int(execution_time)}` seconds")
-        if not result:
-            await processor.msg_update("Error\. No data from server")
-            return
-        markup = InlineKeyboardMarkup(inline_keyboard=IMAGE_KEYBOARD)
-        for it, img in enumerate(result.images):
-            seed = result.info['all_seeds'][it]
-            caption = f"`{style.full_clear}`"
-        
-            await msg.answer_document(document=BufferedInputFile(ImageToBytes(img), f"{seed}.png"),caption=caption, parse_mode="MarkdownV2", reply_markup=markup)
-            img.close()
+#original encoded file, passed to img2img as is. Served from files cache when file_unique_id is known
+async def download_image(bot: Bot, file_id: str, file_unique_id: str = None) -> bytes:
+    async def load() -> bytes:
+        with BytesIO() as file_in_io:
+            await bot.download(file_id, destination=file_in_io)
+            return file_in_io.getvalue()
+
+    if file_unique_id is None:
+        return await load()
+    return await files.fetch(file_unique_id, load)
 
-    processor.set_end_func(proc_end)
 
-    try:
-        await processor.to_queue(user.telegram_id)
-    except errors.MaxQueueReached:
-        await update_message.edit_text("You reached queue limit. Please wait before using it again")
-        logger.info(f"User {msg.from_user.full_name} with ID:[{msg.from_user.id}] reached queue limit")
 
+async def any_msg(msg:Message, db:AsyncSession):
+    settings = await user_settings.get(db, msg.from_user.id)
 
+    text = msg.text or msg.caption or ""
+    if len(text) < 1:
+        await msg.answer("Please, provide text for generation")
 
-async def image_reaction(msg: CallbackQuery, callback_data: cb_models.ImageOptions, db: Session, bot: Bot):
-    user = get_user(db, msg.from_user.id)
-    settings = user.settings
+    style = styles.stylize(settings.quality_tag, text)
+    params = generation_params(settings, style)
+
+    await submit(msg, msg.from_user, params, generation_processor(params), f"`{style.full_clear}`")
+
+
+
+async def image_reaction(msg: CallbackQuery, callback_data: cb_models.ImageOptions, db: AsyncSession, bot: Bot):
+    settings = await user_settings.get(db, msg.from_user.id)
     mode = callback_data.mode
 
     image = msg.message.document
     if msg.message.photo and len(msg.message.photo > 0):
         image = msg.message.photo[0]
+    if image is None and msg.message.reply_to_message: #keyboard message of media group
+        image = msg.message.reply_to_message.document
 
     text = msg.message.text or msg.message.caption or ""
 
     style = styles.stylize(settings.quality_tag, text)
+    caption = f"`{style.full_clear}`"
+
+    await msg.answer()
+
+    if mode == "upscale":
+        data = await download_image(bot, image.file_id, image.file_unique_id)
+        width, height = ImageSize(data)
+
+        params = img2img_params()
+        params.width = RoundTo8(width)
+        params.height = RoundTo8(height)
+        params.prompt = style.positive
+        params.negative_prompt = style.negative
+        params.init_images = [data]
+        params.script_name = "SD Upscale"
+        params.script_args=["_", 64, "R-ESRGAN 4x+ Anime6B", 2]
+
+        await submit(msg.message, msg.from_user, params, img2img_processor, caption, source_file_id=image.file_id)
+
+    elif mode == "sameprompt":
+        params = generation_params(settings, style)
+
+        await submit(msg.message, msg.from_user, params, generation_processor(params), caption)
+
 
-    with BytesIO() as file_in_io:
-        await bot.download(image, destination=file_in_io)
-        file_in_io.seek(0)
-        with Image.open(file_in_io) as pil_img:
-            width, height = pil_img.size
-            width = RoundTo8(width)
-            height = RoundTo8(height)
-
-            await msg.answer()
-
-            if mode == "upscale":
-                params = img2img_params()
-                params.width = width
-                params.height = height
-                params.prompt = style.positive
-                params.negative_prompt = style.negative
-                params.init_images = [pil_img.copy()]
-                params.script_name = "SD Upscale"
-                params.script_args=["_", 64, "R-ESRGAN 4x+ Anime6B", 2]
-
-                update_message = await msg.message.answer(f"Placed in queue: `{queue.human_size()}`", parse_mode="MarkdownV2")
-                processor = img2img_processor(api, queue, params, initial_message=update_message)
-
-                async def proc_end(result: WebUIApiResult):
-                    assert result
-                    await processor.msg_update(f"Done in `{int(processor.get_process_time())}` seconds")
-                    markup = InlineKeyboardMarkup(inline_keyboard=IMAGE_KEYBOARD)
-                    for it, img in enumerate(result.images):
-                        await msg.message.answer_document(document=BufferedInputFile(ImageToBytes(img), f"{result.info['all_seeds'][it]}.png"),caption=f"`{style.full_clear}`", parse_mode="MarkdownV2", reply_markup=markup)
-                        img.close()
-
-                processor.set_end_func(proc_end)
-
-                try: await processor.to_queue(user.telegram_id)
-                except errors.MaxQueueReached:
-                    await update_message.edit_text("You reached queue limit. Please wait before using it again")
-                    logger.info(f"User {msg.from_user.full_name} with ID:[{msg.from_user.id}] reached queue limit")
-
-            elif mode == "sameprompt":
-                if not settings.enable_hr:
-                    params = txt2img_params()
-                else:
-                    params = txt2img_sdupscale_params()
-
-                width, height = ConvertRatioToSize(IMAGE_BASE_SIZE, settings.aspect_x, settings.aspect_y)
-                params.width = width
-                params.height = height
-                params.prompt = style.positive
-                params.negative_prompt = style.negative
-                params.steps = settings.steps
-                params.batch_size = settings.n_iter
-                params.sampler_name = settings.sampler
-
-                update_message = await msg.message.answer(f"Placed in queue: `{queue.human_size()}`", parse_mode="MarkdownV2")
-                msg = msg.message
-                
-                if isinstance(params, txt2img_sdupscale_params):
-                    processor = txt2img_sdupscale_processor(api, queue, params, initial_message=update_message)
-                elif isinstance(params, txt2img_params):
-                    processor = txt2img_processor(api, queue, params, initial_message=update_message)
-
-                async def proc_end(result: WebUIApiResult):
-                    execution_time = processor.get_process_time()
-                    await processor.msg_update(f"Done in `{int(execution_time)}` seconds")
-                    if not result:
-                        await processor.msg_update("Error\. No data from server")
-                        return
-                    markup = InlineKeyboardMarkup(inline_keyboard=IMAGE_KEYBOARD)
-                    for it, img in enumerate(result.images):
-                        seed = result.info['all_seeds'][it]
-                        caption = f"`{style.full_clear}`"
-                    
-                        await msg.answer_document(document=BufferedInputFile(ImageToBytes(img), f"{seed}.png"),caption=caption, parse_mode="MarkdownV2", reply_markup=markup)
-                        img.close()
-
-                processor.set_end_func(proc_end)
-
-                try:
-                    await processor.to_queue(user.telegram_id)
-                except errors.MaxQueueReached:
-                    await update_message.edit_text("You reached queue limit. Please wait before using it again")
-                    logger.info(f"User {msg.from_user.full_name} with ID:[{msg.from_user.id}] reached queue limit")
+
+#put jobs interrupted by restart back to queue
+async def restore_jobs(bot: Bot):
+    for job in await jobs.unfinished():
+        try:
+            params = load_params(PARAMS[job.kind], job.params)
+            if job.source_file_id:
+                params.init_images = [await download_image(bot, job.source_file_id)]
+
+            queue.check(job.telegram_id, params.cost(), block=True) #nothing is posted for jobs which can't be queued
+
+            processor = PROCESSORS[job.kind](api, queue, params, initial_message=None)
+            processor.ticket = job.ticket or processor.ticket #cancel button of old queue message keeps working
+            text = "Restored after restart\. " + queue_text(job.telegram_id, params)
+            update_message = await messages.send(job.chat_id, lambda: bot.send_message(
+                job.chat_id, text, parse_mode="MarkdownV2", reply_markup=processor.cancel_markup()
+            ))
+            processor.initial_message = update_message
+            processor.job_id = job.id
+            processor.set_end_func(make_delivery(processor, update_message, job.caption, await result_key(processor)))
+
+            try:
+                await processor.to_queue(job.telegram_id, block=True)
+            except (Exception, errors.MaxQueueReached):
+                messages.edit(update_message, "Job was dropped after restart\. Please send it again", final=True)
+                raise
+            logger.info(f"Restored job {job.id} of user [{job.telegram_id}]")
+        except (Exception, errors.MaxQueueReached) as E:
+            logger.error(f"Can't restore job {job.id}: {E}")
+            await jobs.mark(job.id, JobStore.FAILED)
+
+
+
+
+
+async def cancel_job(query: CallbackQuery, callback_data: cb_models.JobOptions):
+    state = await queue.cancel(callback_data.ticket, query.from_user.id)
+    if state is None:
+        await query.answer("Nothing to cancel")
+        return
+
+    await query.answer("Cancelled")
+    messages.edit(query.message, "Cancelled", final=True) #coalesced with processor's own update
+    logger.info(f"User {query.from_user.full_name} with ID:[{query.from_user.id}] cancelled {state} job")
 
 
 
 
 
 class CommandHandler(ABC):
-    def __init__(self, master: SettingsMaster, query: CallbackQuery, data: list, db: Session):
+    def __init__(self, master: SettingsMaster, query: CallbackQuery, data: list, db: AsyncSession):
         self.master = master
         self.query = query
         self.data = data
         self.db = db
-        self.user = get_user(db, query.from_user.id)
-        self.settings = self.user.settings
+        self.settings: models.UserSettings = None #loaded by run
         self.prefix = data[0]
         self.mode = data[1]
 
-    def db_save_changes(self):
-        self.db.add(self.settings)
-        self.db.commit()
-        self.db.refresh(self.settings)
+    async def run(self):
+        self.settings = await user_settings.get(self.db, self.query.from_user.id)
+        await self.handle()
+
+    #written to DB later, see settings_cache.SettingsCache
+    def save_changes(self):
+        user_settings.save(self.query.from_user.id, self.settings)
 
     @abstractmethod
     async def handle(self):
@@ -243,7 +376,7 @@ class CountHandler(CommandHandler):
             return #no need to update and save
 
         self.settings.n_iter = new_value
-        self.db_save_changes()
+        self.save_changes()
         await self.menu()
 
     async def menu(self):
@@ -269,8 +402,8 @@ class CountHandler(CommandHandler):
             case _:
                 await self.menu()
 
-async def count_setting(master: SettingsMaster, query: CallbackQuery, data: list, db: Session):
-    await CountHandler(master, query, data, db).handle()
+async def count_setting(master: SettingsMaster, query: CallbackQuery, data: list, db: AsyncSession):
+    await CountHandler(master, query, data, db).run()
 
 
 class RatioHandler(CommandHandler):
@@ -279,11 +412,11 @@ class RatioHandler(CommandHandler):
             self.settings.aspect_x, self.settings.aspect_y = aspect_y, aspect_x
         else:
             self.settings.aspect_x, self.settings.aspect_y = aspect_x, aspect_y
-        self.db_save_changes()
+        self.save_changes()
     
     async def inverse(self):
         self.settings.aspect_x, self.settings.aspect_y = self.settings.aspect_y, self.settings.aspect_x
-        self.db_save_changes()
+        self.save_changes()
     
     async def menu(self):
         kb = []
@@ -321,8 +454,8 @@ class RatioHandler(CommandHandler):
                 await self.inverse()
         await self.menu()
 
-async def ratio_setting(master: SettingsMaster, query: CallbackQuery, data: list, db: Session):
-    await RatioHandler(master, query, data, db).handle()
+async def ratio_setting(master: SettingsMaster, query: CallbackQuery, data: list, db: AsyncSession):
+    await RatioHandler(master, query, data, db).run()
 
 
 
@@ -330,7 +463,7 @@ async def ratio_setting(master: SettingsMaster, query: CallbackQuery, data: list
 class UpscaleHandler(CommandHandler):
     async def mode_switch(self):
         self.settings.enable_hr = not self.settings.enable_hr
-        self.db_save_changes()
+        self.save_changes()
 
     async def menu(self):
         kb = []
@@ -354,5 +487,5 @@ class UpscaleHandler(CommandHandler):
                 await self.mode_switch()
         await self.menu()
 
-async def upscale_setting(master: SettingsMaster, query: CallbackQuery, data: list, db: Session):
-    await UpscaleHandler(master, query, data, db).handle()
+async def upscale_setting(master: SettingsMaster, query: CallbackQuery, data: list, db: AsyncSession):
+    await UpscaleHandler(master, query, data, db).run()
@@ -6,4 +6,13 @@ class MaxQueueReached(BaseException):
 
     def __str__(self):
         if self.message: return "MaxQueueReached: {0}".format(self.message)
-        else: return "MaxQueueReached"
\ No newline at end of file
+        else: return "MaxQueueReached"
+
+class SystemBusy(BaseException):
+    def __init__(self, *args, retry_after: float = 0):
+        self.message = args[0] if args else None
+        self.retry_after = retry_after
+
+    def __str__(self):
+        if self.message: return "SystemBusy: {0} (retry in {1:.0f}s)".format(self.message, self.retry_after)
+        else: return "SystemBusy"
\ No newline at end of file
@@ -0,0 +1,64 @@
+import logging
+
+from .api_models import JobCost
+
+
+logger = logging.getLogger("telebot")
+
+
+#online estimate of job duration: seconds = a + b * cost, fitted by exponentially weighted
+#least squares separately for plain and upscale jobs
+class DurationEstimator():
+    class Model():
+        def __init__(self):
+            self.sw = self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+        def add(self, x: float, y: float, decay: float):
+            self.sw = self.sw * decay + 1
+            self.sx = self.sx * decay + x
+            self.sy = self.sy * decay + y
+            self.sxx = self.sxx * decay + x * x
+            self.sxy = self.sxy * decay + x * y
+
+        def predict(self, x: float, default_rate: float) -> float:
+            if self.sw < 1e-9:
+                return default_rate * x
+            var = self.sw * self.sxx - self.sx * self.sx
+            if var <= 1e-9 * max(self.sw * self.sxx, 1):
+                #all samples of same cost, only scale is known
+                return (self.sy / self.sx) * x if self.sx > 0 else self.sy / self.sw
+            b = (self.sw * self.sxy - self.sx * self.sy) / var
+            a = (self.sy - b * self.sx) / self.sw
+            return max(a + b * x, 0)
+
+    def __init__(self, default_rate = 5, decay = 0.98, residual_alpha = 0.1, slowdown_threshold = 1.5):
+        self.default_rate = default_rate #seconds per cost unit before any job finished
+        self.decay = decay
+        self.residual_alpha = residual_alpha
+        self.slowdown_threshold = slowdown_threshold
+
+        self.models = {False: self.Model(), True: self.Model()}
+        self.slowdown = 1.0 #EWMA of actual / predicted
+        self.samples = 0
+
+    def __model(self, cost: JobCost) -> Model:
+        return self.models[cost.upscale > 0]
+
+    def predict(self, cost: JobCost) -> float:
+        if cost is None:
+            return self.default_rate
+        return self.__model(cost).predict(cost.value, self.default_rate)
+
+    def record(self, cost: JobCost, seconds: float):
+        if cost is None:
+            return
+
+        predicted = self.predict(cost)
+        if predicted > 0:
+            was_slow = self.slowdown > self.slowdown_threshold
+            self.slowdown += self.residual_alpha * (seconds / predicted - self.slowdown)
+            if self.slowdown > self.slowdown_threshold and not was_slow:
+                logger.warning(f"Backend slowdown: jobs take {self.slowdown:.2f}x of estimated time")
+
+        self.__model(cost).add(cost.value, seconds, self.decay)
+        self.samples += 1
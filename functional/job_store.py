@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+
+from database import models
+
+from .api_models import IMAGE_FIELDS
+
+
+logger = logging.getLogger("telebot")
+
+#images are not stored, img2img input is downloaded again by source_file_id
+SKIP_PARAMS = IMAGE_FIELDS
+
+
+def dump_params(params) -> dict:
+    return {
+        attr: getattr(params, attr) for attr in dir(params)
+        if not attr.startswith("__") and attr not in SKIP_PARAMS and not callable(getattr(params, attr))
+    }
+
+def load_params(params_cls, data: dict):
+    params = params_cls()
+    for k, v in data.items():
+        setattr(params, k, v)
+    return params
+
+
+#durable record of every queued job, so restart can resume unfinished ones
+class JobStore():
+    QUEUED = "queued"
+    RUNNING = "running"
+    GENERATED = "generated"
+    DELIVERED = "delivered"
+    FAILED = "failed"
+    REJECTED = "rejected"
+    CANCELLED = "cancelled"
+
+    UNFINISHED = (QUEUED, RUNNING, GENERATED)
+    FINISHED = (DELIVERED, FAILED, REJECTED, CANCELLED)
+
+    def __init__(self, session_maker = None, max_attempts = 3):
+        self.configure(session_maker, max_attempts)
+
+    def configure(self, session_maker, max_attempts = 3):
+        self.session_maker = session_maker
+        self.max_attempts = max_attempts
+
+        self.marks: list[tuple[int, str, datetime]] = [] #states from mark_later, written in order
+        self.task: Optional[asyncio.Task] = None #writes marks, runs while there are any
+
+    async def __add(self, telegram_id, chat_id, kind, params, caption, source_file_id, ticket) -> int:
+        async with self.session_maker() as db:
+            job = models.Job(
+                telegram_id=telegram_id,
+                chat_id=chat_id,
+                kind=kind,
+                params=dump_params(params),
+                caption=caption,
+                source_file_id=source_file_id,
+                ticket=ticket,
+            )
+            db.add(job)
+            await db.commit()
+            return job.id
+
+    async def __apply(self, db, job_id: int, state: str, at: datetime):
+        job = await db.get(models.Job, job_id)
+        if job is None:
+            return
+        job.state = state
+        if state == self.RUNNING:
+            job.started_at = at
+            job.attempts = (job.attempts or 0) + 1
+        elif state in self.FINISHED:
+            job.finished_at = at
+
+    async def __mark(self, job_id: int, state: str):
+        async with self.session_maker() as db:
+            await self.__apply(db, job_id, state, datetime.utcnow())
+            await db.commit()
+
+    #marks which arrived while previous batch was written go in one transaction
+    async def __write_marks(self):
+        while self.marks:
+            marks, self.marks = self.marks, []
+            try:
+                async with self.session_maker() as db:
+                    for job_id, state, at in marks:
+                        await self.__apply(db, job_id, state, at)
+                    await db.commit()
+            except Exception as E:
+                logger.error(f"Can't write {len(marks)} job states: {E}")
+            except BaseException:
+                self.marks = marks + self.marks #cancelled, written by close()
+                raise
+
+    async def __unfinished(self) -> list[models.Job]:
+        async with self.session_maker() as db:
+            query = select(models.Job).where(models.Job.state.in_(self.UNFINISHED)).order_by(models.Job.id)
+            jobs = (await db.scalars(query)).all()
+
+        resumable = []
+        for job in jobs:
+            if (job.attempts or 0) >= self.max_attempts:
+                logger.warning(f"Job {job.id} failed {job.attempts} times, dropping it")
+                await self.__mark(job.id, self.FAILED)
+            else:
+                resumable.append(job)
+        return resumable
+
+    async def add(self, telegram_id, chat_id, kind, params, caption = "", source_file_id = None, ticket = None) -> int:
+        if self.session_maker is None:
+            return None
+        return await self.__add(telegram_id, chat_id, kind, params, caption, source_file_id, ticket)
+
+    async def mark(self, job_id: int, state: str):
+        if job_id is None or self.session_maker is None:
+            return
+        try:
+            await self.__mark(job_id, state)
+        except Exception as E:
+            logger.error(f"Can't mark job {job_id} as {state}: {E}")
+
+    #same as mark, but returns at once. Used by queue workers
+    def mark_later(self, job_id: int, state: str):
+        if job_id is None or self.session_maker is None:
+            return
+        self.marks.append((job_id, state, datetime.utcnow()))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.__write_marks())
+
+    async def unfinished(self) -> list[models.Job]:
+        return await self.__unfinished()
+
+    async def close(self):
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        if self.marks: #left by cancelled write
+            await self.__write_marks()
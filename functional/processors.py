@@ -1,23 +1,39 @@
-from functional.sd_api import txt2img_params, txt2img_sdupscale_params, img2img_params, StyleFactory, WebUIApi, APIQueue
+from functional.sd_api import txt2img_params, txt2img_sdupscale_params, img2img_params, StyleFactory, WebUIApi, WebUIApiPool, APIQueue
+from functional.api_models import SDProgress
+from functional.throttle import messages
 from time import time
+from copy import copy
+from contextlib import ExitStack
+from abc import ABC, abstractmethod
+import json
 
 from aiogram import types
+from aiogram.types import InlineKeyboardButton as IKB, InlineKeyboardMarkup
 from aiogram.utils.text_decorations import markdown_decoration as md
 
+from callbacks import models as cb_models
 
-class default_processor():
+
+class default_processor(ABC):
     def __init__(self, queue: APIQueue, process_func = None, update_func = None, end_func = None):
         self.queue = queue
         self.process_func = process_func
         self.update_func = update_func
         self.end_func = end_func
+        self.job_id = None #durable record, see job_store.JobStore
+        self.ticket = APIQueue.new_ticket() #used by cancel button
+        self.cancelled = False
+        self.uid = None
+        self.timings: dict[str, float] = {} #stage -> unix time, see database.ledger.STAGES
     
     async def on_process(self):
         await self.process_func()
-    async def on_update(self):
-        await self.update_func()
+    async def on_update(self, status: SDProgress):
+        await self.update_func(status)
     async def on_end(self, result):
         await self.end_func(result)
+    async def on_interrupt(self, stop_backend: bool):
+        self.cancelled = True
 
     #setters
     def set_process_func(self, fn):
@@ -27,33 +43,115 @@ class default_processor():
     def set_end_func(self, fn):
         self.end_func = fn
     
-    async def to_queue(self, uid):
+    def cost(self) -> float:
+        return 1
+
+    def features(self):
+        return None
+
+    #payload which fully defines result, None - result is random and can't be cached
+    def deterministic_payload(self):
+        return None
+
+    #jobs with equal key can be merged into one backend call, None - never merge
+    def coalesce_key(self):
+        return None
+
+    def size(self) -> int:
+        return 1
+
+    #runs several coalesced processors at once, returns result per processor
+    @staticmethod
+    @abstractmethod
+    async def process_batch(processors: list) -> list:
+        pass
+
+    async def to_queue(self, uid, block = False):
+        self.uid = uid
+        self.timings["enqueued"] = time()
         await self.queue.put( APIQueue.Params (
             uid=uid,
             func=self.on_process,
-            update_func=self.on_update, #no ()! only coroutine fabric!
             end_func=self.on_end,
-        ))
+            cost=self.cost(),
+            features=self.features(),
+            coalesce_key=self.coalesce_key(),
+            batch_func=self.process_batch,
+            context=self,
+            size=self.size(),
+            job_id=self.job_id,
+            ticket=self.ticket,
+            interrupt_func=self.on_interrupt,
+        ), block)
 
 
 class queue_processor(default_processor):
-    def __init__(self, api:WebUIApi, queue: APIQueue, initial_message: types.Message):
+    def __init__(self, api:WebUIApiPool, queue: APIQueue, initial_message: types.Message):
         self.initial_message = initial_message
         self.api = api
+        self.backend: WebUIApi = None #backend which runs this job
         self.start_time = None
+        self.end_time = None
 
         super().__init__(queue, None, None, None)
 
-    #prevent message is not modified error
-    async def msg_update(self, text):
-        if self.initial_message.text != text:
-            self.initial_message = await self.initial_message.edit_text(text, parse_mode="MarkdownV2")
+    def cancel_markup(self) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            IKB(text="✖️ Cancel", callback_data=cb_models.JobOptions(action="cancel", ticket=self.ticket).pack())
+        ]])
+
+    #edit is throttled and coalesced, final - last state of message, never replaced by progress
+    async def msg_update(self, text, reply_markup: InlineKeyboardMarkup = None, final = False):
+        messages.edit(self.initial_message, text, reply_markup, final)
+
+    #stop generation on backend, unless backend is busy with other jobs too
+    async def on_interrupt(self, stop_backend: bool):
+        self.cancelled = True
+        await self.msg_update("Cancelled", final=True)
+        if stop_backend and self.backend is not None and self.api.exclusive(self.backend):
+            await self.backend.interrupt()
 
+    #generation time, delivery runs later and is not counted
     def get_process_time(self):
-        return time() - self.start_time
+        return (self.end_time or time()) - self.start_time
+
+    def cost(self) -> float:
+        return self.params.cost().value
+
+    def features(self):
+        return self.params.cost()
+
+    @abstractmethod
+    async def generate(self, backend: WebUIApi):
+        pass
+
+    #kinds which are never merged (coalesce_key is None) run one by one
+    @staticmethod
+    async def process_batch(processors: list["queue_processor"]) -> list:
+        return [await p.on_process() for p in processors]
+
+    async def on_start(self):
+        self.start_time = self.timings["started"] = time()
+        #queue message is edited without waiting, worker must not wait for telegram rate limits
+        await self.msg_update(md.quote("Generation..."), self.cancel_markup())
+
+    async def on_process(self):
+        await self.on_start()
+        
+        try:
+            async with self.api.acquire() as backend:
+                self.backend = backend
+                with backend.progress.watch(self.on_update):
+                    return await self.generate(backend)
+        except Exception as E:
+            await self.msg_update(f"Error: {E}", final=True)
+        finally:
+            self.end_time = time()
 
-    async def on_update(self):
-        status = await self.api.get_progress()
+    #called by backend progress poller while job runs
+    async def on_update(self, status: SDProgress):
+        if self.cancelled:
+            return
 
         progress = status.progress
         negative_progress = 1 - progress
@@ -67,48 +165,77 @@ class queue_processor(default_processor):
         message = f"{md.quote('Generating...')} "\
                 f"{progress_str}\n"\
                 f"{progress_bar if not waiting else ''}\n"
-        await self.msg_update(message)
+        await self.msg_update(message, self.cancel_markup())
 
 
 class txt2img_processor(queue_processor):
-    def __init__(self, api:WebUIApi, queue: APIQueue, params:txt2img_params, initial_message: types.Message):
+    kind = "txt2img"
+
+    def __init__(self, api:WebUIApiPool, queue: APIQueue, params:txt2img_params, initial_message: types.Message):
         self.params = params
         super().__init__(api, queue, initial_message)
 
-    async def on_process(self):
-        self.start_time = time()
-        self.initial_message = await self.initial_message.answer("Generation...") #update current message to new message
-        
+    async def generate(self, backend: WebUIApi):
+        return await backend.txt2img(self.params)
+
+    def size(self) -> int:
+        return self.params.batch_size * self.params.n_iter
+
+    def deterministic_payload(self):
+        if self.params.seed == -1:
+            return None
+        return {"kind": self.kind, **self.params.to_dict()}
+
+    def coalesce_key(self):
+        #fixed seed would shift inside merged batch, so only random seed jobs are merged
+        if self.params.seed != -1 or self.params.n_iter != 1:
+            return None
+        payload = self.params.to_dict()
+        del payload["batch_size"]
+        return json.dumps(payload, sort_keys=True, default=str)
+
+    @staticmethod
+    async def process_batch(processors: list["txt2img_processor"]) -> list:
+        head = processors[0]
+        for p in processors:
+            if not p.cancelled: #cancelled while waiting for batch, keeps its "Cancelled" message
+                await p.on_start()
+
+        params = copy(head.params)
+        params.batch_size = sum(p.params.batch_size for p in processors)
         try:
-            return await self.api.txt2img(self.params)
+            async with head.api.acquire() as backend:
+                with ExitStack() as watchers:
+                    for p in processors:
+                        p.backend = backend
+                        watchers.enter_context(backend.progress.watch(p.on_update))
+                    result = await backend.txt2img(params)
         except Exception as E:
-            await self.msg_update(f"Error: {E}")
+            for p in processors:
+                await p.msg_update(f"Error: {E}", final=True)
+            return [None] * len(processors)
+        finally:
+            for p in processors:
+                p.end_time = time()
+
+        return result.split([p.params.batch_size for p in processors])
 
 class txt2img_sdupscale_processor(queue_processor):
-    def __init__(self, api:WebUIApi, queue: APIQueue, params:txt2img_sdupscale_params, initial_message: types.Message):
+    kind = "txt2img_sdupscale"
+
+    def __init__(self, api:WebUIApiPool, queue: APIQueue, params:txt2img_sdupscale_params, initial_message: types.Message):
         self.params = params
         super().__init__(api, queue, initial_message)
 
-    async def on_process(self):
-        self.start_time = time()
-        self.initial_message = await self.initial_message.answer("Generation...") #update current message to new message
-        
-        try:
-            return await self.api.txt2img_sdupscale(self.params)
-        except Exception as E:
-            await self.msg_update(f"Error: {E}")
+    async def generate(self, backend: WebUIApi):
+        return await backend.txt2img_sdupscale(self.params)
 
 class img2img_processor(queue_processor):
-    def __init__(self, api:WebUIApi, queue: APIQueue, params:img2img_params, initial_message: types.Message):
+    kind = "img2img"
+
+    def __init__(self, api:WebUIApiPool, queue: APIQueue, params:img2img_params, initial_message: types.Message):
         self.params = params
         super().__init__(api, queue, initial_message)
 
-    async def on_process(self):
-        self.start_time = time()
-        self.initial_message = await self.initial_message.answer("Generation...") #update current message to new message
-        
-        try:
-            return await self.api.img2img(self.params)
-        except Exception as E:
-            await self.msg_update(f"Error: {E}")
-
+    async def generate(self, backend: WebUIApi):
+        return await backend.img2img(self.params)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+
+from time import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, Optional
+
+from .api_models import SDProgress
+from .shared import clamp
+
+
+logger = logging.getLogger("telebot")
+
+
+#one /progress poll per backend, result is fanned out to every job watching it
+class ProgressPoller():
+    def __init__(self, fetch: Callable[[], Awaitable[SDProgress]], min_interval = 0.5, max_interval = 3):
+        self.fetch = fetch
+        self.configure(min_interval, max_interval)
+
+        self.subscribers: dict[Callable, Optional[asyncio.Task]] = {} #callback -> its running call
+        self.task: Optional[asyncio.Task] = None
+        self.latest: Optional[SDProgress] = None
+        self.latest_time = 0
+
+    def configure(self, min_interval = 0.5, max_interval = 3):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+
+    #poll often when job is about to finish, rarely while waiting
+    def interval(self, status: Optional[SDProgress]) -> float:
+        if status is None or status.progress <= 0:
+            return self.max_interval
+        return clamp(status.eta_relative / 4, self.min_interval, self.max_interval)
+
+    def subscribe(self, callback: Callable[[SDProgress], Awaitable]):
+        self.subscribers[callback] = None
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.__poll())
+
+    def unsubscribe(self, callback: Callable[[SDProgress], Awaitable]):
+        task = self.subscribers.pop(callback, None)
+        if task is not None:
+            task.cancel()
+
+    @contextmanager
+    def watch(self, callback: Callable[[SDProgress], Awaitable]) -> Iterator[None]:
+        self.subscribe(callback)
+        try:
+            yield
+        finally:
+            self.unsubscribe(callback)
+
+    def close(self):
+        for callback in list(self.subscribers):
+            self.unsubscribe(callback)
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def __call(self, callback, status: SDProgress):
+        try:
+            await callback(status)
+        except Exception as E:
+            logger.error(f"Progress update failed: {E}")
+
+    #slow subscriber skips ticks instead of piling up calls, it gets latest status next time
+    def __fan_out(self, status: SDProgress):
+        for callback, task in list(self.subscribers.items()):
+            if task is None or task.done():
+                self.subscribers[callback] = asyncio.create_task(self.__call(callback, status))
+
+    async def __poll(self):
+        while self.subscribers:
+            status = None
+            try:
+                status = await self.fetch()
+                self.latest, self.latest_time = status, time()
+                self.__fan_out(status)
+            except Exception as E:
+                logger.error(f"Can't get progress: {E}")
+
+            await asyncio.sleep(self.interval(status))
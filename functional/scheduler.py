@@ -0,0 +1,197 @@
+import asyncio
+from abc import ABC, abstractmethod
+from copy import copy
+from collections import deque, OrderedDict
+from typing import Any
+
+
+#asyncio.Queue-like container for APIQueue jobs, subclasses only decide the order
+class BaseScheduler(ABC):
+    def __init__(self, maxsize = 0):
+        self.maxsize = maxsize
+        self._count = 0
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    @abstractmethod
+    def _push(self, item):
+        pass
+
+    @abstractmethod
+    def _pop(self) -> Any:
+        pass
+
+    @abstractmethod
+    def _remove(self, predicate) -> list:
+        pass
+
+    #copy with own containers, used to simulate serving order
+    @abstractmethod
+    def _clone(self) -> "BaseScheduler":
+        pass
+
+    def qsize(self) -> int:
+        return self._count
+
+    def empty(self) -> bool:
+        return self._count == 0
+
+    def full(self) -> bool:
+        return self.maxsize > 0 and self._count >= self.maxsize
+
+    def _update_events(self):
+        if self._count > 0: self._not_empty.set()
+        else: self._not_empty.clear()
+
+        if self.full(): self._not_full.clear()
+        else: self._not_full.set()
+
+    def put_nowait(self, item):
+        if self.full():
+            raise asyncio.QueueFull
+        self._push(item)
+        self._count += 1
+        self._update_events()
+
+    async def put(self, item):
+        while self.full():
+            await self._not_full.wait()
+        self.put_nowait(item)
+
+    def get_nowait(self) -> Any:
+        if self.empty():
+            raise asyncio.QueueEmpty
+        item = self._pop()
+        self._count -= 1
+        self._update_events()
+        return item
+
+    async def get(self) -> Any:
+        #several workers may wake up on the same item, losers just wait again
+        while self.empty():
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    #queued items in serving order, extra - hypothetical item to place among them
+    def ordered(self, extra = None) -> list:
+        clone = self._clone()
+        count = self._count
+        if extra is not None:
+            clone._push(extra)
+            count += 1
+        return [clone._pop() for _ in range(count)]
+
+    #take out every queued item matching predicate, in serving order
+    def remove(self, predicate) -> list:
+        items = self._remove(predicate)
+        self._count -= len(items)
+        self._update_events()
+        return items
+
+
+class FIFOScheduler(BaseScheduler):
+    def __init__(self, maxsize = 0):
+        super().__init__(maxsize)
+        self.items = deque()
+
+    def _push(self, item):
+        self.items.append(item)
+
+    def _pop(self):
+        return self.items.popleft()
+
+    def _clone(self):
+        clone = copy(self)
+        clone.items = deque(self.items)
+        return clone
+
+    def _remove(self, predicate) -> list:
+        removed = [item for item in self.items if predicate(item)]
+        if removed:
+            self.items = deque(item for item in self.items if not any(item is r for r in removed))
+        return removed
+
+
+#per-user sub-queues served by deficit round robin inside each priority class.
+#items must have uid, cost and priority attributes (see APIQueue.Params)
+class FairScheduler(BaseScheduler):
+    def __init__(self, maxsize = 0, weighted = True, quantum = 1.0):
+        super().__init__(maxsize)
+        self.weighted = weighted
+        self.quantum = quantum
+
+        self.rings: dict[int, OrderedDict] = {} #priority -> (uid -> deque of items)
+        self.deficit: dict = {}
+
+    def _cost(self, item) -> float:
+        return item.cost if self.weighted else self.quantum
+
+    def _push(self, item):
+        ring = self.rings.setdefault(item.priority, OrderedDict())
+        if item.uid not in ring:
+            ring[item.uid] = deque()
+            self.deficit[item.uid] = 0
+        ring[item.uid].append(item)
+
+    def _pop(self):
+        level = max(k for k, ring in self.rings.items() if ring) #strict priority between classes
+        ring = self.rings[level]
+
+        while True:
+            uid, items = next(iter(ring.items()))
+            cost = self._cost(items[0])
+
+            if self.deficit[uid] < cost:
+                self.deficit[uid] += self.quantum
+                if self.deficit[uid] < cost:
+                    ring.move_to_end(uid)
+                    continue
+
+            item = items.popleft()
+            self.deficit[uid] -= cost
+
+            if not items:
+                del ring[uid]
+                del self.deficit[uid]
+                if not ring:
+                    del self.rings[level]
+            elif self.deficit[uid] < self._cost(items[0]):
+                ring.move_to_end(uid) #turn is over
+            return item
+
+    def _clone(self):
+        clone = copy(self)
+        clone.rings = {level: OrderedDict((uid, deque(items)) for uid, items in ring.items()) for level, ring in self.rings.items()}
+        clone.deficit = dict(self.deficit)
+        return clone
+
+    def _remove(self, predicate) -> list:
+        removed = []
+        for level in sorted(self.rings, reverse=True):
+            ring = self.rings[level]
+            for uid in list(ring):
+                items = ring[uid]
+                taken = [item for item in items if predicate(item)]
+                if not taken:
+                    continue
+                removed += taken
+                ring[uid] = deque(item for item in items if not any(item is t for t in taken))
+                if not ring[uid]:
+                    del ring[uid]
+                    del self.deficit[uid]
+            if not ring:
+                del self.rings[level]
+        return removed
+
+
+SCHEDULERS = {
+    "fifo": lambda maxsize: FIFOScheduler(maxsize),
+    "round_robin": lambda maxsize: FairScheduler(maxsize, weighted=False),
+    "deficit": lambda maxsize: FairScheduler(maxsize, weighted=True),
+}
+
+def make_scheduler(name: str, maxsize = 0) -> BaseScheduler:
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {name}. Available: {', '.join(SCHEDULERS)}")
+    return SCHEDULERS[name](maxsize)
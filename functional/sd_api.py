@@ -2,16 +2,23 @@ import aiohttp, requests
 import asyncio
 
 
-import json, io, base64, logging
+import json, io, logging, secrets
 from PIL import Image
 
-from typing import Coroutine, Optional
+from time import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Coroutine, Optional
 from pydantic import ValidationError
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 
-from .api_models import txt2img_params, txt2img_sdupscale_params, img2img_params, SDModel, SDProgress
+from .api_models import txt2img_params, txt2img_sdupscale_params, img2img_params, SDModel, SDProgress, JobCost
+from .scheduler import BaseScheduler, make_scheduler
+from .eta import DurationEstimator
 
 from . import errors
+from .shared import ImageToBytes
+from .stream_json import WebUIResponseParser, json_body_stream
+from .progress import ProgressPoller
 
 
 logger = logging.getLogger("telebot")
@@ -78,126 +85,383 @@ class StyleFactory():
 
 
 class APIQueue():
-    def __init__(self, def_limit = 4, custom_limits:dict = {}, max_tasks = 10, update_sleep = 2):
-        self.busy = False
-        self.configure(def_limit, custom_limits, max_tasks, update_sleep)
+    def __init__(self, *args, **kwargs):
+        self.configure(*args, **kwargs)
 
-    def configure(self, def_limit = 4, custom_limits:dict = {}, max_tasks = 10, update_sleep = 2):
+    def configure(self, def_limit = 4, custom_limits:dict = {}, max_tasks = 10, workers = 1, delivery_workers = 2, delivery_max = 8,
+                  scheduler = "fifo", custom_priorities:dict = {}, coalesce_window = 0, coalesce_max = 4, journal = None, estimator = None,
+                  shed_threshold = 0.7, shed_cost = 4):
         self.limit = def_limit
         self.custom_limits = custom_limits
-        self.update_sleep = update_sleep
-
-        self.queue = asyncio.Queue(max_tasks)
+        self.custom_priorities = custom_priorities #uid -> priority class, higher is served first
+        self.workers = max(workers, 1)
+        self.delivery_workers = max(delivery_workers, 1)
+        self.coalesce_window = coalesce_window #seconds to wait for compatible jobs, 0 - disabled
+        self.coalesce_max = coalesce_max #max images in merged batch
+        self.journal = journal #durable job states, see job_store.JobStore
+        self.estimator: DurationEstimator = estimator or DurationEstimator()
+        #load shedding: when queue is filled above shed_threshold, jobs costing more than shed_cost are rejected
+        self.shed_threshold = shed_threshold
+        self.shed_cost = shed_cost
+
+        self.queue: BaseScheduler = make_scheduler(scheduler, max_tasks)
+        #finished jobs waiting for encoding/upload, bounded so workers get backpressure
+        self.delivery = asyncio.Queue(delivery_max)
         self.counts = {}
+        self.busy: dict[int, list[APIQueue.Params]] = {} #worker id -> running jobs (several if coalesced)
+        self.started: dict[int, float] = {} #worker id -> start time of running jobs
+        self.undelivered: list[APIQueue.Params] = [] #generated jobs waiting in delivery queue
 
     @dataclass
     class Params():
         uid: str
         func: Coroutine
-        update_func: Coroutine = None
         end_func: Coroutine = None
+        cost: float = 1 #see api_models.JobCost
+        features: JobCost = None #cost features for duration estimation
+        priority: int = 0 #filled by APIQueue.put from custom_priorities
+
+        #coalescing: jobs with equal key are merged and run by batch_func([context, ...]) -> [result, ...]
+        coalesce_key: Optional[str] = None
+        batch_func: Callable[[list], Coroutine] = None
+        context: Any = None
+        size: int = 1 #images produced by job
+        job_id: Optional[int] = None #durable record id
+
+        #cancellation: ticket identifies job in callbacks, interrupt_func(stop_backend) notifies job owner
+        ticket: Optional[str] = None
+        interrupt_func: Callable[[bool], Coroutine] = None
+        cancelled: bool = False
+
+    @staticmethod
+    def new_ticket() -> str:
+        return secrets.token_hex(4)
 
     def size(self) -> int:
         return self.queue.qsize()
     
+    def busy_count(self) -> int:
+        return len(self.busy)
+
     def human_size(self) -> int:
         count = self.size()+1
-        if self.busy:
+        if self.busy_count() >= self.workers: #no free worker, wait for running job too
             count += 1
         return count
         
+    #features of merged group, as one backend call
+    def __group_features(self, group: list[Params]) -> JobCost:
+        if any(p.features is None for p in group):
+            return None
+        if len(group) == 1:
+            return group[0].features
+        return replace(group[0].features, batch=sum(p.features.batch for p in group))
+
+    #estimated seconds left for every running job
+    def __running_work(self) -> float:
+        now = time()
+        work = 0
+        for worker_id, group in list(self.busy.items()):
+            elapsed = now - self.started.get(worker_id, now)
+            work += max(self.estimator.predict(self.__group_features(group)) - elapsed, 0)
+        return work
+
+    #seconds until job starts and until it is done
+    def eta(self, params: Params) -> tuple[float, float]:
+        order = self.queue.ordered()
+        if not any(p is params for p in order):
+            order = self.queue.ordered(extra=params) #not queued yet, where would it be placed
+
+        work = self.__running_work()
+        for p in order:
+            if p is params:
+                break
+            work += self.estimator.predict(p.features)
+
+        wait = work / self.workers
+        return wait, wait + self.estimator.predict(params.features)
+
+    #eta of job which is about to be placed
+    def estimate(self, uid, features: JobCost) -> tuple[float, float]:
+        probe = self.Params(
+            uid=uid,
+            func=None,
+            cost=features.value if features else 1,
+            features=features,
+            priority=self.custom_priorities.get(uid, 0)
+        )
+        return self.eta(probe)
+
     async def __get_one(self) -> Params:
         return await self.queue.get()
 
-    #special update coroutine
-    async def __process_update(self, update_coro):
+    #journal writes in background, workers never wait for DB
+    def __mark(self, group: list[Params], state: str):
+        if self.journal is None:
+            return
+        for p in group:
+            self.journal.mark_later(p.job_id, state)
+
+    def __release(self, uid):
+        #check user counter
+        if uid in self.counts:
+            self.counts[uid] -= 1
+            if self.counts[uid] < 1:
+                del self.counts[uid]
+
+    async def __coalesce(self, params: Params) -> list[Params]:
+        if self.coalesce_window <= 0 or params.coalesce_key is None or params.batch_func is None:
+            return [params]
+
+        await asyncio.sleep(self.coalesce_window) #let compatible jobs arrive
+        total = params.size
+        def fits(other: APIQueue.Params) -> bool:
+            nonlocal total
+            if other.coalesce_key != params.coalesce_key or total + other.size > self.coalesce_max:
+                return False
+            total += other.size
+            return True
+
+        return [params] + self.queue.remove(fits)
+
+    async def __run(self, group: list[Params]) -> list:
+        if len(group) == 1:
+            return [await group[0].func()]
+
+        results = await group[0].batch_func([p.context for p in group])
+        logger.info(f"Coalesced {len(group)} jobs into one batch")
+        return results
+
+    async def __worker(self, worker_id: int):
         while True:
+            params = await self.__get_one()
+            #job is always in queue, busy or undelivered, so cancel can find it
+            self.busy[worker_id] = [params]
+            group = await self.__coalesce(params)
+            self.busy[worker_id] = group
+            self.__mark(group, "running")
+
+            results = [None] * len(group)
+            self.started[worker_id] = time()
             try:
-                await update_coro() #create new coro and run it
+                if not all(p.cancelled for p in group): #cancelled while waiting for compatible jobs
+                    results = await self.__run(group)
+                if all(results) and not any(p.cancelled for p in group):
+                    self.estimator.record(self.__group_features(group), time() - self.started[worker_id])
             except Exception as E:
-                logger.error(f"Error occured in SD_API: {E}")
-                break
-            
+                logger.error(f"[worker {worker_id}] Job of {params.uid} failed: {E}")
             finally:
-                await asyncio.sleep(self.update_sleep) 
-            
+                handoff = [not p.cancelled and p.end_func is not None for p in group]
+                self.undelivered.extend(p for p, delivered in zip(group, handoff) if delivered)
+                del self.busy[worker_id]
+                del self.started[worker_id]
+                for p in group:
+                    self.__release(p.uid)
+
+            for p, result, delivered in zip(group, results, handoff):
+                if delivered: #cancelled from now on is handled by delivery worker
+                    self.__mark([p], "generated" if result else "failed")
+                    await self.delivery.put((p, result))
+                elif p.cancelled:
+                    self.__mark([p], "cancelled")
+                else:
+                    self.__mark([p], "generated" if result else "failed")
+
+    async def __delivery_worker(self, worker_id: int):
+        while True:
+            params, result = await self.delivery.get()
+            self.undelivered.remove(params)
+            if params.cancelled:
+                self.__mark([params], "cancelled")
+                self.delivery.task_done()
+                continue
+            try:
+                await params.end_func(result)
+                if result:
+                    self.__mark([params], "delivered")
+            except Exception as E:
+                logger.error(f"[delivery {worker_id}] End function of {params.uid} failed: {E}")
+                self.__mark([params], "failed")
+            finally:
+                self.delivery.task_done()
 
     async def process_requests(self):
-        update_task = None
+        await asyncio.gather(
+            *[self.__worker(i) for i in range(self.workers)],
+            *[self.__delivery_worker(i) for i in range(self.delivery_workers)],
+        )
+
+    #seconds until `count` queued jobs are taken by workers
+    def __drain_time(self, count: int) -> float:
+        work = self.__running_work()
+        work += sum(self.estimator.predict(p.features) for p in self.queue.ordered()[:max(count - 1, 0)])
+        return work / self.workers
+
+    #raises errors.MaxQueueReached or errors.SystemBusy if job can't be accepted right now
+    def __admit(self, params: Params, block = False):
+        uid = params.uid
 
-        while True:
-            params = await self.__get_one()
-            uid = params.uid
-            coro = params.func
-            update_coro = params.update_func
-            end_func = params.end_func
+        max_count = self.limit
+        if uid in self.custom_limits:
+            max_count = self.custom_limits[uid]
 
-            # Update worker
-            if update_coro and update_task is None:
-                update_task = asyncio.create_task(self.__process_update(update_coro))
+        if self.counts.get(uid, 0) >= max_count:
+            raise errors.MaxQueueReached("Максимальное количество одновременных запросов достигнуто")
 
-            try:
-                self.busy = True
-                result = await coro()
-            finally:
-                self.busy = False
-                self.queue.task_done() #end task
+        if block or self.queue.maxsize <= 0:
+            return
 
-                #check user counter
-                if uid in self.counts:
-                    self.counts[uid] -= 1
-                    if self.counts[uid] < 1:
-                        del self.counts[uid]
+        if self.queue.full():
+            raise errors.SystemBusy("Queue is full", retry_after=self.__drain_time(1))
 
-                if update_task is not None:
-                    update_task.cancel()
-                    update_task = None
+        threshold = int(self.queue.maxsize * self.shed_threshold)
+        if self.size() >= threshold and params.cost > self.shed_cost:
+            raise errors.SystemBusy("Queue is under pressure, expensive job rejected", retry_after=self.__drain_time(self.size() - threshold + 1))
 
-                if end_func is not None:
-                    await end_func(result)
+    #check admission before job is built, same errors as put
+    def check(self, uid, features: JobCost = None, block = False):
+        self.__admit(self.Params(uid=uid, func=None, cost=features.value if features else 1, features=features), block)
 
-    async def put(self, params:Params):
+    async def __interrupt(self, params: Params, stop_backend: bool):
+        params.cancelled = True
+        if params.interrupt_func is None:
+            return
+        try:
+            await params.interrupt_func(stop_backend)
+        except Exception as E:
+            logger.error(f"Can't interrupt job {params.ticket}: {E}")
+
+    #cancel job of uid by ticket. Returns "queued" or "running" if found, None otherwise
+    async def cancel(self, ticket: str, uid) -> Optional[str]:
+        removed = self.queue.remove(lambda p: p.ticket == ticket and p.uid == uid)
+        for p in removed:
+            self.__release(p.uid)
+            await self.__interrupt(p, False)
+            self.__mark([p], "cancelled")
+        if removed:
+            return "queued"
+
+        for group in list(self.busy.values()):
+            for p in group:
+                if p.ticket == ticket and p.uid == uid and not p.cancelled:
+                    #merged batch is shared with other jobs, only its delivery is skipped
+                    await self.__interrupt(p, len(group) == 1)
+                    return "running"
+
+        #already generated, waiting for delivery
+        for p in self.undelivered:
+            if p.ticket == ticket and p.uid == uid and not p.cancelled:
+                await self.__interrupt(p, False)
+                return "running"
+        return None
+
+    #never waits for free space unless block is set (used for restored jobs)
+    async def put(self, params:Params, block = False):
         uid = params.uid
+        self.__admit(params, block)
 
-        if uid not in self.counts:
-            self.counts[uid] = 0
+        params.priority = self.custom_priorities.get(uid, 0)
 
-        max_count = self.limit
-        if uid in self.custom_limits:
-            max_count = self.custom_limits[uid]
-
-        if self.counts[uid] >= max_count:
-            raise errors.MaxQueueReached("Максимальное количество одновременных запросов достигнуто")
-        
-        self.counts[uid] += 1
-        await self.queue.put(params)
+        self.counts[uid] = self.counts.get(uid, 0) + 1
+        try:
+            if block:
+                await self.queue.put(params)
+            else:
+                self.queue.put_nowait(params)
+        except BaseException:
+            self.__release(uid)
+            raise
 
 
 
 @dataclass
 class WebUIApiResult:
-    images: list[Image.Image]
+    raw_images: list[bytes] #encoded exactly as backend sent them
     parameters: dict
     info: dict
+    decoded: Optional[list[Image.Image]] = field(default=None, repr=False)
+    timings: dict[str, float] = field(default_factory=dict, repr=False) #"response" - backend answered, "decoded" - body parsed
+
+    #PIL images are opened only when something needs pixels
+    @property
+    def images(self) -> list[Image.Image]:
+        if self.decoded is None:
+            self.decoded = [Image.open(io.BytesIO(raw)) for raw in self.raw_images]
+        return self.decoded
         
     @property
     def image(self) -> Image.Image:
         return self.images[0]
 
+    @property
+    def raw_image(self) -> bytes:
+        return self.raw_images[0]
+
+    #split merged batch result back, sizes - images per part
+    def split(self, sizes: list[int]) -> list["WebUIApiResult"]:
+        total = len(self.raw_images)
+        parts = []
+        start = 0
+        for size in sizes:
+            end = start + size
+            info = self.info
+            if isinstance(info, dict):
+                #per-image lists (all_seeds, all_prompts, infotexts...) follow images order
+                info = {k: (v[start:end] if isinstance(v, list) and len(v) == total else v) for k, v in info.items()}
+                if "all_seeds" in info and info["all_seeds"]:
+                    info["seed"] = info["all_seeds"][0]
+            parts.append(WebUIApiResult(self.raw_images[start:end], self.parameters, info, timings=self.timings))
+            start = end
+        return parts
+
 
 
 
 class WebUIApi():
-    def __init__(self, host, port):
+    def __init__(self, host, port, **session_options):
         self.models: list[SDModel] = []
         self.upscalers = []
-        self.configure(host,port)
-
-    def configure(self, host, port):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.checkpoint: Optional[str] = None #loaded model title, e.g. "model.safetensors [hash]"
+        self.checkpoint_time = 0
+        self.progress = ProgressPoller(self.get_progress) #shared by all jobs running here
+        self.configure(host, port, **session_options)
+
+    def configure(self, host, port, limit_per_host = 8, keepalive_timeout = 60, dns_cache_ttl = 300,
+                  progress_min = 0.5, progress_max = 3):
         self.host = host
         self.port = port
         self.baseurl = f'http://{host}:{port}/sdapi/v1'
         self.timeout = aiohttp.ClientTimeout(total=9999)
+        self.read_chunk = 256 * 1024
+
+        #connector pool options, applied on next session creation
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+
+        self.progress.configure(progress_min, progress_max)
+
+    #long-lived session, created lazily inside running loop
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+            )
+            self.session = aiohttp.ClientSession(timeout=self.timeout, connector=connector)
+        return self.session
+
+    async def start(self):
+        self.get_session()
+
+    async def close(self):
+        self.progress.close()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
             
     def __recieve_models(self) -> list[SDModel]:
         response = requests.get(url=f'{self.baseurl}/sd-models')
@@ -235,15 +499,16 @@ class WebUIApi():
 
 
     async def _to_api_result(self, response) -> WebUIApiResult:
+        response_time = time()
         if response.status != 200:
             raise RuntimeError(response.status, await response.text())
         
-        r = await response.json()
-        images = []
-        if 'images' in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(i))) for i in r['images']]
-        elif 'image' in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r['image'])))]
+        #images are decoded while body streams in, whole document is never buffered
+        parser = WebUIResponseParser()
+        async for chunk in response.content.iter_chunked(self.read_chunk):
+            parser.feed(chunk)
+        r = parser.finish()
+        images = parser.images
         
         info = ''
         if 'info' in r.keys():
@@ -258,19 +523,35 @@ class WebUIApi():
         if 'parameters' in r.keys():
             parameters = r['parameters']
 
-        return WebUIApiResult(images, parameters, info)
+        return WebUIApiResult(images, parameters, info, timings={"response": response_time, "decoded": time()})
     
+    async def get_checkpoint(self, ttl = 60) -> Optional[str]:
+        if self.checkpoint is None or time() - self.checkpoint_time > ttl:
+            session = self.get_session()
+            async with session.get(url=f'{self.baseurl}/options') as response:
+                if response.status != 200:
+                    raise RuntimeError(response.status, await response.text())
+                self.checkpoint = (await response.json()).get("sd_model_checkpoint")
+                self.checkpoint_time = time()
+        return self.checkpoint
+
+    async def interrupt(self):
+        session = self.get_session()
+        async with session.post(url=f'{self.baseurl}/interrupt') as response:
+            if response.status != 200:
+                raise RuntimeError(response.status, await response.text())
+
     async def get_progress(self, skip_current_image = True) -> SDProgress:
-        async with aiohttp.ClientSession(timeout=self.timeout) as session:
-            async with session.get(url=f'{self.baseurl}/progress',params={"skip_current_image": str(skip_current_image)}) as response:
-                return SDProgress( **(await response.json()) )
+        session = self.get_session()
+        async with session.get(url=f'{self.baseurl}/progress',params={"skip_current_image": str(skip_current_image)}) as response:
+            return SDProgress( **(await response.json()) )
             
     async def get_upscalers(self):
         if len(self.upscalers) < 1:
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.get(url=f'{self.baseurl}/upscalers') as response:
-                    self.upscalers = await response.json()
-                    return self.upscalers
+            session = self.get_session()
+            async with session.get(url=f'{self.baseurl}/upscalers') as response:
+                self.upscalers = await response.json()
+                return self.upscalers
         else:
             return self.upscalers
     
@@ -288,16 +569,27 @@ class WebUIApi():
     async def txt2img(self, params: txt2img_params) -> WebUIApiResult:
         payload = params.to_dict()
 
-        async with aiohttp.ClientSession(timeout=self.timeout) as session:
-            async with session.post(url=f'{self.baseurl}/txt2img', json=payload) as response:
-                return await self._to_api_result(response)
+        session = self.get_session()
+        async with session.post(url=f'{self.baseurl}/txt2img', json=payload) as response:
+            return await self._to_api_result(response)
             
+    @staticmethod
+    def __encoded(image: Image.Image | bytes) -> bytes:
+        if isinstance(image, (bytes, bytearray)):
+            return bytes(image)
+        return ImageToBytes(image)
+
+    #body is streamed, init images are base64-encoded while being sent
     async def img2img(self, params: img2img_params) -> WebUIApiResult:
-        payload = params.to_dict()
+        images = {
+            "init_images": [self.__encoded(i) for i in params.init_images],
+            "mask": self.__encoded(params.mask) if params.mask is not None else None,
+        }
+        body = json_body_stream(params.fields(), images)
 
-        async with aiohttp.ClientSession(timeout=self.timeout) as session:
-            async with session.post(url=f'{self.baseurl}/img2img', json=payload) as response:
-                return await self._to_api_result(response)
+        session = self.get_session()
+        async with session.post(url=f'{self.baseurl}/img2img', data=body, headers={"Content-Type": "application/json"}) as response:
+            return await self._to_api_result(response)
             
     async def txt2img_sdupscale(self, params: txt2img_sdupscale_params) -> WebUIApiResult:
         response = await self.txt2img(params)
@@ -308,7 +600,7 @@ class WebUIApi():
             raise ValueError("[txt2img_sdupscale] Argument upscaler is invalid!")
 
         own_images = []
-        for img in response.images:
+        for img in response.raw_images:
             pr = img2img_params()
             pr.init_images = [img]
             pr.prompt = "best quality, good quality, hdr, masterpiece" #params.prompt
@@ -329,6 +621,135 @@ class WebUIApi():
 
 
             img2img_result = await self.img2img(pr)
-            own_images.append(img2img_result.image)
+            own_images.append(img2img_result.raw_image)
+
+        timings = {"response": response.timings.get("response"), "decoded": time()}
+        return WebUIApiResult(own_images,response.parameters,response.info,timings=timings)
+
+
+
+#set of WebUI backends, each job is routed to the least loaded healthy one
+class WebUIApiPool():
+    @dataclass
+    class Backend():
+        api: WebUIApi
+        capacity: int = 1
+        in_flight: int = 0
+        latency: Optional[float] = None #EWMA of job duration, seconds
+        down_until: float = 0
+
+        @property
+        def healthy(self) -> bool:
+            return time() >= self.down_until
+
+        @property
+        def load(self) -> float:
+            return self.in_flight / max(self.capacity, 1)
+
+    def __init__(self, urls: list[str] = [], capacity = 1, retry_after = 30, latency_alpha = 0.3, **session_options):
+        self.backends: list[WebUIApiPool.Backend] = []
+        self.configure(urls, capacity, retry_after, latency_alpha, **session_options)
+
+    def configure(self, urls: list[str], capacity = 1, retry_after = 30, latency_alpha = 0.3, **session_options):
+        self.retry_after = retry_after
+        self.latency_alpha = latency_alpha
+
+        self.backends = []
+        for url in urls:
+            host, port = url.strip().rsplit(":", 1)
+            self.backends.append(self.Backend(WebUIApi(host, port, **session_options), capacity))
+
+    @property
+    def capacity(self) -> int:
+        return sum(b.capacity for b in self.backends)
+
+    @property
+    def models(self) -> list[SDModel]:
+        return self.get_models()
 
-        return WebUIApiResult(own_images,response.parameters,response.info)
+    def update_models(self):
+        for backend in self.backends:
+            try:
+                backend.api.update_models()
+            except Exception as E:
+                logger.error(f"Backend {backend.api.baseurl} unavailable: {E}")
+                self.mark_down(backend)
+
+    def get_models(self) -> list[SDModel]:
+        for backend in self.backends:
+            if backend.api.models:
+                return backend.api.models
+        return []
+
+    async def start(self):
+        for backend in self.backends:
+            await backend.api.start()
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.api.close()
+
+    def mark_down(self, backend: Backend):
+        backend.down_until = time() + self.retry_after
+        logger.warning(f"Backend {backend.api.baseurl} marked unhealthy for {self.retry_after}s")
+
+    #model loaded on every healthy backend, None if they differ or can't be asked
+    async def get_checkpoint(self) -> Optional[str]:
+        candidates = [b for b in self.backends if b.healthy]
+        if not candidates:
+            return None
+        try:
+            checkpoints = await asyncio.gather(*[b.api.get_checkpoint() for b in candidates])
+        except Exception as E:
+            logger.error(f"Can't get loaded model: {E}")
+            return None
+        if len(set(checkpoints)) != 1:
+            return None
+        return checkpoints[0]
+
+    #true if api runs only one job, so interrupting it affects nobody else
+    def exclusive(self, api: WebUIApi) -> bool:
+        for backend in self.backends:
+            if backend.api is api:
+                return backend.in_flight <= 1
+        return False
+
+    def pick(self) -> Backend:
+        if len(self.backends) < 1:
+            raise RuntimeError("No WebUI backends configured")
+
+        #if everything is down, try anyway: first request after recovery brings it back
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        return min(candidates, key=lambda b: (b.load, b.latency or 0))
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[WebUIApi]:
+        backend = self.pick()
+        backend.in_flight += 1
+        start = time()
+        try:
+            yield backend.api
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            self.mark_down(backend)
+            raise
+        else:
+            elapsed = time() - start
+            if backend.latency is None:
+                backend.latency = elapsed
+            else:
+                backend.latency += self.latency_alpha * (elapsed - backend.latency)
+            backend.down_until = 0
+        finally:
+            backend.in_flight -= 1
+
+    async def txt2img(self, params: txt2img_params) -> WebUIApiResult:
+        async with self.acquire() as api:
+            return await api.txt2img(params)
+
+    async def img2img(self, params: img2img_params) -> WebUIApiResult:
+        async with self.acquire() as api:
+            return await api.img2img(params)
+
+    async def txt2img_sdupscale(self, params: txt2img_sdupscale_params) -> WebUIApiResult:
+        async with self.acquire() as api:
+            return await api.txt2img_sdupscale(params)
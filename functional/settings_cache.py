@@ -0,0 +1,102 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import models
+
+from .shared import get_user
+
+
+logger = logging.getLogger("telebot")
+
+
+#user settings kept in memory, changes are written to DB in batches some time later
+class SettingsCache():
+    def __init__(self, session_maker = None, max_users = 10000, flush_interval = 5):
+        self.configure(session_maker, max_users, flush_interval)
+
+    def configure(self, session_maker, max_users = 10000, flush_interval = 5):
+        self.session_maker = session_maker
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+
+        self.entries: OrderedDict[int, models.UserSettings] = OrderedDict() #telegram id -> settings, oldest first
+        self.dirty: dict[int, models.UserSettings] = {} #changed, not written yet
+        self.flushing: dict[int, models.UserSettings] = {} #being written now
+        self.task: Optional[asyncio.Task] = None #timer, only waits
+        self.flushes: set[asyncio.Task] = set() #writes started by timer, referenced until done
+
+    def __remember(self, telegram_id: int, settings: models.UserSettings):
+        self.entries[telegram_id] = settings
+        self.entries.move_to_end(telegram_id)
+        while len(self.entries) > self.max_users:
+            self.entries.popitem(last=False) #dirty ones stay in self.dirty until flushed
+
+    #settings of user, registers new user. db is used only on cache miss
+    #and its connection goes back to the pool right after the lookup
+    async def get(self, db: AsyncSession, telegram_id: int) -> models.UserSettings:
+        settings = self.entries.get(telegram_id) or self.dirty.get(telegram_id) or self.flushing.get(telegram_id)
+        if settings is None:
+            user = await get_user(db, telegram_id)
+            settings = user.settings
+            db.expunge(settings) #owned by cache from now on
+            await db.commit() #ends transaction, handler may keep running for long
+        self.__remember(telegram_id, settings)
+        return settings
+
+    #call after settings object was changed
+    def save(self, telegram_id: int, settings: models.UserSettings):
+        self.__remember(telegram_id, settings)
+        self.dirty[telegram_id] = settings
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.__flush_later())
+
+    #timer never writes itself, so close() can cancel it without interrupting a write
+    async def __flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        if self.flushes:
+            await asyncio.wait(self.flushes) #one write at a time, wait doesn't cancel it if timer is cancelled
+        task = asyncio.create_task(self.flush())
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    @staticmethod
+    def __row(settings: models.UserSettings) -> dict:
+        return {column.key: getattr(settings, column.key) for column in models.UserSettings.__table__.columns if column.key != "user_id"}
+
+    #write every changed settings in one statement
+    async def flush(self):
+        if not self.dirty or self.session_maker is None:
+            return
+        self.flushing, self.dirty = self.dirty, {}
+        try:
+            async with self.session_maker() as db:
+                await db.execute(update(models.UserSettings), [self.__row(s) for s in self.flushing.values()])
+                await db.commit()
+            logger.info(f"Saved settings of {len(self.flushing)} users")
+        except Exception as E:
+            logger.error(f"Can't save settings of {len(self.flushing)} users: {E}")
+            self.dirty = {**self.flushing, **self.dirty} #retry next time, newer changes win
+            if self.task is None or self.task.done() or self.task is asyncio.current_task():
+                self.task = asyncio.create_task(self.__flush_later())
+        except BaseException:
+            self.dirty = {**self.flushing, **self.dirty} #cancelled, written by close()
+            raise
+        finally:
+            self.flushing = {}
+
+    async def close(self):
+        while self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True) #writes in progress are finished, not cancelled
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+        await self.flush()
+
+
+user_settings = SettingsCache()
@@ -5,13 +5,11 @@ from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardButton as IKB, InlineKeyboardMarkup, Message, CallbackQuery
 
-from functools import wraps
-
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from dataclasses import dataclass
 
-from functional.shared import get_user
+from functional.settings_cache import user_settings
 
 logger = logging.getLogger("telebot")
 
@@ -25,8 +23,8 @@ class SettingsCallback():
 
 
 class SettingsMaster():
-    def __init__(self, command:str, db_session_maker, buttons_per_row = 3, router = Router()):
-        self.session_maker = db_session_maker
+    #handlers get `db` session from functional.middlewares.DBSessionMiddleware
+    def __init__(self, command:str, buttons_per_row = 3, router = Router()):
         self.command = command
         self.router = router
         self.buttons_per_row = buttons_per_row
@@ -36,21 +34,17 @@ class SettingsMaster():
 
         #main message handler
         @self.router.message(Command(command))
-        async def _(msg: Message) -> None:
-            db = self.session_maker()
-            try: await msg.answer(text=self.generate_main_menu(), reply_markup=self.generate_keyboard(msg.from_user.id, db))
+        async def _(msg: Message, db: AsyncSession) -> None:
+            try: await msg.answer(text=self.generate_main_menu(), reply_markup=await self.generate_keyboard(msg.from_user.id, db))
             except Exception as E: 
                 logger.error(E.with_traceback())
-                db.close()
 
         #back to menu handler
         @self.router.callback_query(F.data == self.arg_pack(self.command, "to_menu"))
-        async def _(query: CallbackQuery) -> None:
-            db = self.session_maker()
-            try: await query.message.edit_text(text=self.generate_main_menu(), reply_markup=self.generate_keyboard(query.from_user.id, db))
+        async def _(query: CallbackQuery, db: AsyncSession) -> None:
+            try: await query.message.edit_text(text=self.generate_main_menu(), reply_markup=await self.generate_keyboard(query.from_user.id, db))
             except Exception as E: 
                 logger.error(E.with_traceback())
-                db.close()
     
     def arg_pack(self, *args):
         return self.delimeter.join(args)
@@ -67,8 +61,7 @@ class SettingsMaster():
         ) 
         
         @self.router.callback_query(F.data.startswith(prefix))
-        @self.__db_async_session
-        async def _(query: CallbackQuery, db:Session):
+        async def _(query: CallbackQuery, db:AsyncSession):
             data = self.arg_unpack(query.data)
             if len(data[1:]) < 1: 
                 logger.error(f"[{self.command}] Data len < 1 for callback {prefix}! Skipping")
@@ -86,21 +79,11 @@ class SettingsMaster():
     def back_button(self, text:str = "↪️ Back") -> IKB:
         return IKB(text=text, callback_data=self.arg_pack(self.command, "to_menu"))
 
-    def __db_async_session(self,func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            db = self.session_maker()
-            try:
-                await func(db = db, *args, **kwargs)
-            finally:
-                db.close()
-        return wrapper
-    
     def generate_main_menu(self) -> str: 
         return "⚙️ Settings menu"
 
-    def generate_keyboard(self, telegram_id, db:Session) -> InlineKeyboardMarkup:
-        user = get_user(db, telegram_id)
+    async def generate_keyboard(self, telegram_id, db:AsyncSession) -> InlineKeyboardMarkup:
+        settings = await user_settings.get(db, telegram_id)
 
         kb = []
         for k, callback in enumerate(self.get_callbacks()):
@@ -109,7 +92,7 @@ class SettingsMaster():
 
             text = "?"
             if callable(callback.button_text):
-                text = callback.button_text(user.settings)
+                text = callback.button_text(settings)
             elif type(callback.button_text) == str:
                 text = callback.button_text
             
@@ -8,7 +8,11 @@ import logging
 from aiogram import types
 
 from database import models
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 
 
 logger = logging.getLogger("telebot")
@@ -20,12 +24,36 @@ def ImageToBytes(img: Image.Image):
     img_byte_arr.seek(0)
     return img_byte_arr.getvalue()
 
-def ImageToBase64(image: Image.Image):
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_base64 = 'data:image/png;base64,' + str(base64.b64encode(buffered.getvalue()), 'utf-8')
+IMAGE_SIGNATURES = {
+    b"\x89PNG": ("image/png", "png"),
+    b"\xff\xd8\xff": ("image/jpeg", "jpg"),
+    b"RIFF": ("image/webp", "webp"),
+    b"GIF8": ("image/gif", "gif"),
+}
+
+#mime type and file extension of encoded image
+def ImageFormat(data: bytes) -> tuple[str, str]:
+    for signature, fmt in IMAGE_SIGNATURES.items():
+        if data.startswith(signature):
+            return fmt
+    return ("image/png", "png")
+
+#already encoded bytes are sent as is
+def ImageToBase64(image: Image.Image | bytes):
+    if isinstance(image, (bytes, bytearray)):
+        data = bytes(image)
+    else:
+        data = ImageToBytes(image)
+    mime, _ = ImageFormat(data)
+    img_base64 = f'data:{mime};base64,' + str(base64.b64encode(data), 'utf-8')
     return img_base64
 
+#reads only image header, pixels are not decoded
+def ImageSize(data: bytes) -> tuple[int, int]:
+    with Image.open(BytesIO(data)) as img:
+        return img.size
+
+
 def KBCustom(inputs,callback_strings,size):
     if len(inputs) != len(callback_strings):
         raise ValueError("rounded_keyboard_custom - inputs and callback_strings: must be a same size")
@@ -57,16 +85,38 @@ def ConvertRatioToSize(base_size:int, ratio_x:float, ratio_y:float) -> tuple[int
         ratio = ratio_x / ratio_y
         return (RoundTo8(base_size*ratio), RoundTo8(base_size*ratio))
     
-def get_user(db: Session, telegram_id: int) -> models.User:
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
-    
-    #create new user
-    if not user:
-        logger.info(f"Created new user [{telegram_id}]")
+#INSERT ... ON CONFLICT per dialect
+UPSERT_INSERTS = {
+    "sqlite": sqlite_insert,
+    "postgresql": postgresql_insert,
+}
+
+#insert user and settings unless they exist. Concurrent first messages create user once
+async def create_user(db: AsyncSession, telegram_id: int):
+    insert = UPSERT_INSERTS.get(db.get_bind().dialect.name)
+    if insert is None:
         user = models.User(telegram_id=telegram_id)
         user.settings = models.UserSettings()
         db.add(user)
-        db.commit()
+        await db.commit()
+        return
+
+    user_id = (await db.execute(
+        insert(models.User).values(telegram_id=telegram_id).on_conflict_do_nothing(index_elements=["telegram_id"]).returning(models.User.id)
+    )).scalar()
+    if user_id is not None:
+        await db.execute(insert(models.UserSettings).values(user_id=user_id).on_conflict_do_nothing(index_elements=["user_id"]))
+        logger.info(f"Created new user [{telegram_id}]")
+    await db.commit()
+
+#user with settings in one query, async session can't load them lazily
+async def get_user(db: AsyncSession, telegram_id: int) -> models.User:
+    query = select(models.User).options(joinedload(models.User.settings)).where(models.User.telegram_id == telegram_id)
+    user = (await db.scalars(query)).first()
+    
+    if not user:
+        await create_user(db, telegram_id)
+        user = (await db.scalars(query)).first()
     
     return user
 
@@ -0,0 +1,276 @@
+import base64
+import json
+import re
+from typing import AsyncIterator, Iterator, Optional
+
+from .shared import ImageFormat
+
+
+STRING_STOP = re.compile(rb'["\\]')
+WHITESPACE = b" \t\r\n"
+ESCAPES = {ord("/"): b"/", ord("\\"): b"\\", ord('"'): b'"'}
+
+
+#incremental parser of WebUI JSON response. Base64 images (`images` array or `image` string) are
+#decoded element by element as chunks arrive, so the whole document is never held in memory.
+#other top-level fields are small and parsed with json.loads
+class WebUIResponseParser():
+    def __init__(self, stream_keys = ("images", "image")):
+        self.stream_keys = stream_keys
+        self.fields = {}
+        self.images: list[bytes] = []
+
+        self.buf = bytearray()
+        self.pos = 0
+        self.state = "start"
+        self.key: Optional[str] = None
+
+        self.raw = bytearray() #captured plain value or key
+        self.depth = 0
+        self.in_string = False
+
+        self.pending = bytearray() #base64 chars not yet decoded (less than 4 or waiting for prefix)
+        self.out: Optional[bytearray] = None
+        self.prefix_checked = False
+        self.image_return = None #state after image string ends
+
+    @property
+    def done(self) -> bool:
+        return self.state == "end"
+
+    def feed(self, chunk: bytes):
+        self.buf += chunk
+        while self.__step():
+            pass
+        del self.buf[:self.pos]
+        self.pos = 0
+
+    def finish(self) -> dict:
+        if not self.done:
+            raise ValueError(f"Incomplete JSON response, stopped in state {self.state}")
+        return self.fields
+
+    def __skip_ws(self) -> Optional[int]:
+        while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+            self.pos += 1
+        if self.pos >= len(self.buf):
+            return None
+        return self.buf[self.pos]
+
+    def __expect(self, char: bytes) -> bool:
+        c = self.__skip_ws()
+        if c is None:
+            return False
+        if c != char[0]:
+            raise ValueError(f"Unexpected {chr(c)!r} at state {self.state}, expected {char.decode()!r}")
+        self.pos += 1
+        return True
+
+    #returns False when more data is needed
+    def __step(self) -> bool:
+        match self.state:
+            case "start":
+                if not self.__expect(b"{"): return False
+                self.state = "key_or_end"
+
+            case "key_or_end":
+                c = self.__skip_ws()
+                if c is None: return False
+                self.pos += 1
+                if c == ord("}"):
+                    self.state = "end"
+                elif c == ord('"'):
+                    self.raw.clear()
+                    self.state = "key"
+                elif c != ord(","):
+                    raise ValueError(f"Unexpected {chr(c)!r} while waiting for key")
+
+            case "key":
+                if not self.__read_string(self.raw): return False
+                self.key = json.loads(b'"' + self.raw + b'"')
+                self.state = "colon"
+
+            case "colon":
+                if not self.__expect(b":"): return False
+                self.state = "value"
+
+            case "value":
+                c = self.__skip_ws()
+                if c is None: return False
+                if self.key in self.stream_keys and c == ord("["):
+                    self.pos += 1
+                    self.fields[self.key] = None
+                    self.state = "array"
+                elif self.key in self.stream_keys and c == ord('"'):
+                    self.pos += 1
+                    self.fields[self.key] = None
+                    self.__start_image("after_value")
+                else:
+                    self.raw.clear()
+                    self.depth = 0
+                    self.in_string = False
+                    self.state = "raw"
+
+            case "array":
+                c = self.__skip_ws()
+                if c is None: return False
+                self.pos += 1
+                if c == ord("]"):
+                    self.state = "after_value"
+                elif c == ord('"'):
+                    self.__start_image("array")
+                elif c != ord(","):
+                    raise ValueError(f"Unexpected {chr(c)!r} in images array")
+
+            case "image":
+                if not self.__read_image(): return False
+                self.state = self.image_return
+
+            case "raw":
+                if not self.__read_raw(): return False
+                self.fields[self.key] = json.loads(self.raw)
+                self.state = "after_value"
+
+            case "after_value":
+                c = self.__skip_ws()
+                if c is None: return False
+                self.pos += 1
+                if c == ord(","):
+                    self.state = "key_or_end"
+                elif c == ord("}"):
+                    self.state = "end"
+                else:
+                    raise ValueError(f"Unexpected {chr(c)!r} after value of {self.key}")
+
+            case "end":
+                self.pos = len(self.buf)
+                return False
+        return True
+
+    #copy string body (escapes kept) into target up to closing quote
+    def __read_string(self, target: bytearray) -> bool:
+        while True:
+            m = STRING_STOP.search(self.buf, self.pos)
+            if m is None:
+                target += self.buf[self.pos:]
+                self.pos = len(self.buf)
+                return False
+            target += self.buf[self.pos:m.start()]
+            self.pos = m.start()
+            if self.buf[self.pos] == ord('"'):
+                self.pos += 1
+                return True
+            if self.pos + 1 >= len(self.buf):
+                return False #wait for escaped char
+            target += self.buf[self.pos:self.pos + 2]
+            self.pos += 2
+
+    def __start_image(self, return_state: str):
+        self.pending.clear()
+        self.prefix_checked = False
+        self.out = bytearray()
+        self.image_return = return_state
+        self.state = "image"
+
+    def __decode_pending(self, final = False):
+        if not self.prefix_checked:
+            if len(self.pending) < 5 and not final:
+                return
+            if self.pending.startswith(b"data:"): #data url prefix, e.g. data:image/png;base64,
+                comma = self.pending.find(b",")
+                if comma < 0:
+                    if not final: return #prefix is not complete yet
+                    raise ValueError("Broken data url in image")
+                del self.pending[:comma + 1]
+            self.prefix_checked = True
+
+        size = len(self.pending) if final else len(self.pending) // 4 * 4
+        if size > 0:
+            self.out += base64.b64decode(bytes(self.pending[:size]))
+            del self.pending[:size]
+
+    def __read_image(self) -> bool:
+        while True:
+            m = STRING_STOP.search(self.buf, self.pos)
+            end = m.start() if m else len(self.buf)
+            self.pending += self.buf[self.pos:end]
+            self.pos = end
+            self.__decode_pending()
+            if m is None:
+                return False
+
+            if self.buf[self.pos] == ord('"'):
+                self.pos += 1
+                self.__decode_pending(final=True)
+                self.images.append(bytes(self.out))
+                self.out = None
+                return True
+
+            if self.pos + 1 >= len(self.buf):
+                return False #wait for escaped char
+            escaped = self.buf[self.pos + 1]
+            self.pending += ESCAPES.get(escaped, b"") #\n, \r and others are whitespace here
+            self.pos += 2
+
+    #plain value ends on comma or closing brace of top-level object
+    def __read_raw(self) -> bool:
+        while self.pos < len(self.buf):
+            if self.in_string:
+                if not self.__read_string(self.raw):
+                    return False
+                self.raw += b'"'
+                self.in_string = False
+                continue
+
+            c = self.buf[self.pos]
+            if self.depth == 0 and c in b",}":
+                return True
+            self.pos += 1
+            self.raw.append(c)
+            if c == ord('"'):
+                self.in_string = True
+            elif c in b"[{":
+                self.depth += 1
+            elif c in b"]}":
+                self.depth -= 1
+        return False
+
+
+
+def image_string_chunks(data: bytes, chunk_size: int) -> Iterator[bytes]:
+    mime, _ = ImageFormat(data)
+    yield f'"data:{mime};base64,'.encode()
+    for offset in range(0, len(data), chunk_size):
+        yield base64.b64encode(data[offset:offset + chunk_size])
+    yield b'"'
+
+#JSON object body where image_fields (encoded image bytes, list of them or None) are base64-encoded
+#chunk by chunk while sent. chunk_size must be a multiple of 3 to keep base64 parts joinable
+def json_body_chunks(fields: dict, image_fields: dict, chunk_size = 3 * 16 * 1024) -> Iterator[bytes]:
+    head = json.dumps(fields).encode()
+    if not image_fields:
+        yield head
+        return
+
+    yield head[:-1]
+    separator = b"," if fields else b""
+    for key, value in image_fields.items():
+        yield separator + json.dumps(key).encode() + b":"
+        separator = b","
+
+        if value is None:
+            yield b"null"
+        elif isinstance(value, list):
+            yield b"["
+            for i, data in enumerate(value):
+                if i > 0:
+                    yield b","
+                yield from image_string_chunks(data, chunk_size)
+            yield b"]"
+        else:
+            yield from image_string_chunks(value, chunk_size)
+    yield b"}"
+
+async def json_body_stream(fields: dict, image_fields: dict, chunk_size = 3 * 16 * 1024) -> AsyncIterator[bytes]:
+    for chunk in json_body_chunks(fields, image_fields, chunk_size):
+        yield chunk
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+
+from time import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+
+
+logger = logging.getLogger("telebot")
+T = TypeVar("T")
+
+
+class TokenBucket():
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time()
+
+    def __refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    #seconds until one token is available, 0 - available now
+    def delay(self, now: float) -> float:
+        self.__refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self.__refill(now)
+        return self.tokens >= self.burst
+
+
+#all bot output goes through here to stay under telegram flood limits.
+#sends (new messages, documents) are served first, edits keep only latest text per message
+class MessageThrottler():
+    CHAT_BUCKETS_MAX = 1024
+    SHOWN_MAX = 4096
+
+    @dataclass
+    class Edit():
+        message: Message
+        text: str
+        reply_markup: Optional[InlineKeyboardMarkup] = None
+        final: bool = False #last state of message, e.g. "Done" or error. Served before progress edits
+
+    def __init__(self, *args, **kwargs):
+        self.task: Optional[asyncio.Task] = None
+        self.running: set[asyncio.Task] = set() #edits in flight, referenced until done
+        self.wakeup = asyncio.Event()
+        self.configure(*args, **kwargs)
+
+    def configure(self, rate = 25, chat_rate = 1, chat_burst = 3):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        self.bucket = TokenBucket(rate, rate)
+        self.chats: dict[int, TokenBucket] = {}
+        self.blocked_until = 0 #global backoff after RetryAfter
+
+        self.waiters: deque[tuple[int, asyncio.Future]] = deque() #sends waiting for permit
+        self.edits: OrderedDict[tuple, MessageThrottler.Edit] = OrderedDict() #(chat, message) -> latest pending edit
+        self.inflight: dict[tuple, MessageThrottler.Edit] = {} #edits being applied now
+        self.shown: OrderedDict[tuple, MessageThrottler.Edit] = OrderedDict() #last applied edit per message
+
+    @staticmethod
+    def key(message: Message) -> tuple:
+        return (message.chat.id, message.message_id)
+
+    def backoff(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time() + seconds)
+        logger.warning(f"Telegram flood limit hit, output paused for {seconds}s")
+        self.wakeup.set()
+
+    #run call() when rate limits allow, retried after global backoff on RetryAfter
+    async def send(self, chat_id: int, call: Callable[[], Awaitable[T]]) -> T:
+        while True:
+            await self.__permit(chat_id)
+            try:
+                return await call()
+            except TelegramRetryAfter as E:
+                self.backoff(E.retry_after)
+
+    #schedule edit_text and return at once. Pending edit of same message is replaced
+    def edit(self, message: Message, text: str, reply_markup: InlineKeyboardMarkup = None, final = False):
+        key = self.key(message)
+        latest = self.edits.get(key) or self.inflight.get(key) or self.shown.get(key)
+        if latest is not None and latest.final and not final:
+            return #message already has its last state
+        if key not in self.edits and key not in self.inflight and latest is not None and latest.text == text:
+            return #prevent message is not modified error
+
+        self.edits[key] = self.Edit(message, text, reply_markup, final)
+        self.__notify()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for _, future in self.waiters:
+            future.cancel()
+        self.waiters.clear()
+        self.edits.clear()
+
+    def __notify(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.__dispatcher())
+        self.wakeup.set()
+
+    async def __permit(self, chat_id: int):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((chat_id, future))
+        self.__notify()
+        await future
+
+    def __chat(self, chat_id: int) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.CHAT_BUCKETS_MAX:
+                now = time()
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle(now)}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    #take global and chat token. Returns 0 on success, else seconds to wait
+    def __take(self, chat_id: int, now: float) -> float:
+        chat = self.__chat(chat_id)
+        delay = max(self.bucket.delay(now), chat.delay(now))
+        if delay == 0:
+            self.bucket.take()
+            chat.take()
+        return delay
+
+    async def __apply(self, key: tuple, edit: Edit):
+        try:
+            await edit.message.edit_text(edit.text, parse_mode="MarkdownV2", reply_markup=edit.reply_markup)
+            self.shown[key] = edit
+        except TelegramRetryAfter as E:
+            self.backoff(E.retry_after)
+            self.edits.setdefault(key, edit) #retry, unless newer text arrived
+        except TelegramBadRequest as E:
+            self.shown[key] = edit
+            logger.debug(f"Edit of message {key} skipped: {E}")
+        except Exception as E:
+            logger.error(f"Edit of message {key} failed: {E}")
+        finally:
+            if key in self.shown:
+                self.shown.move_to_end(key)
+            while len(self.shown) > self.SHOWN_MAX:
+                self.shown.popitem(last=False)
+            self.inflight.pop(key, None)
+            self.wakeup.set()
+
+    #grant everything limits allow now, returns seconds until next grant is possible, None - nothing pending
+    def __dispatch(self) -> Optional[float]:
+        if not self.waiters and not self.edits:
+            return None
+        now = time()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        next_delay = None
+        def wait(delay: float):
+            nonlocal next_delay
+            next_delay = delay if next_delay is None else min(next_delay, delay)
+
+        waiting_chats = set()
+        for chat_id, future in list(self.waiters):
+            if future.done(): #caller gave up
+                self.waiters.remove((chat_id, future))
+                continue
+            delay = self.__take(chat_id, now)
+            if delay == 0:
+                self.waiters.remove((chat_id, future))
+                future.set_result(None)
+            else:
+                waiting_chats.add(chat_id)
+                wait(delay)
+
+        for key, edit in sorted(self.edits.items(), key=lambda item: not item[1].final):
+            if key in self.inflight or key[0] in waiting_chats:
+                continue #one edit per message at a time, sends of same chat go first
+            delay = self.__take(key[0], now)
+            if delay == 0:
+                del self.edits[key]
+                self.inflight[key] = edit
+                task = asyncio.create_task(self.__apply(key, edit))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+            else:
+                wait(delay)
+        return next_delay
+
+    async def __dispatcher(self):
+        while True:
+            self.wakeup.clear()
+            delay = self.__dispatch()
+            try:
+                if delay is None:
+                    await self.wakeup.wait()
+                else:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+messages = MessageThrottler()